@@ -78,6 +78,62 @@ def is_enum(data_type):
     return False
 
 
+def enum_symbol_tables(node, method):
+    """Map each enum field of the node schema to a ``{symbol: method(symbol)}`` table.
+
+    Fields holding an array of enums are included, and the symbols of all the enums
+    in a union are merged into one table.
+    """
+    tables = {}
+    for field in node["fields"]:
+        table = None
+        stack = deque([field["type"]])
+        while stack:
+            t = stack.pop()
+            if isinstance(t, list):
+                stack.extend(t)
+                continue
+            if isinstance(t, dict) and t["type"] == "enum":
+                symbols = t["symbols"]
+            elif (
+                isinstance(t, dict)
+                and t["type"] == "array"
+                and isinstance(t["items"], dict)
+                and t["items"]["type"] == "enum"
+            ):
+                symbols = t["items"]["symbols"]
+            else:
+                continue
+            if table is None:
+                table = {}
+            for symbol in symbols:
+                table[symbol] = method(symbol)
+        if table is not None:
+            tables[field["name"]] = table
+    return tables
+
+
+def translate_enums(obj, tables, method):
+    """Translate the enum values of ``obj`` in place using the prepared tables.
+
+    Values missing from a table, e.g. not declared in the schema, fall back to
+    ``method``.
+    """
+    for field, table in tables.items():
+        value = obj.get(field)
+        if not value:
+            continue
+        if isinstance(value, list):
+            obj[field] = [
+                table[element] if element in table else method(element)
+                for element in value
+            ]
+        elif value in table:
+            obj[field] = table[value]
+        else:
+            obj[field] = method(value)
+
+
 def handle_schema_field_unicode(field, encode=True):
     method = encode_enum if encode else decode_enum
     is_enum_ = False
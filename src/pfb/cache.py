@@ -0,0 +1,54 @@
+"""Process-wide cache of compiled PFB schemas.
+
+Compiling the schema of a PFB file, i.e. translating the enum symbols of every node
+and parsing the Avro schema with fastavro, can cost more than reading or writing a
+small PFB file. The compiled forms are cached by a fingerprint of the schema, so
+that PFB files sharing a data dictionary only compile it once per process. Cached
+objects are shared and must not be modified.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+# how many compiled schemas are kept, the least recently used are dropped first
+CACHE_SIZE = 32
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def fingerprint(*parts):
+    """Return a digest of the parts, JSON text or JSON-serializable objects.
+
+    The keys of objects are sorted, and sets are serialized as sorted lists.
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, str):
+            part = json.dumps(
+                part, sort_keys=True, separators=(",", ":"), default=sorted
+            )
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def cached(key, compile_):
+    """Return the value cached for the key, calling ``compile_()`` to make it."""
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    value = compile_()
+    with _lock:
+        _cache[key] = value
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return value
+
+
+def clear_cache():
+    with _lock:
+        _cache.clear()
@@ -10,8 +10,9 @@ except ImportError:
 import click
 import yaml
 
+from .importers.files import ORDERS
 from .reader import PFBReader
-from .writer import PFBWriter
+from .writer import CODEC_ALIASES, CODECS, SYNC_INTERVAL, PFBWriter
 
 default_level = logging.INFO
 config_path = "config.yml"
@@ -24,6 +25,117 @@ else:
     logging.basicConfig(level=default_level)
 
 
+def projection_options(f):
+    """Add the --node and --field options to select what to read from the PFB."""
+    f = click.option(
+        "--field",
+        "fields",
+        metavar="NODE.FIELD",
+        multiple=True,
+        help="Only read this field of NODE, can be repeated.  [default: all]",
+    )(f)
+    f = click.option(
+        "--node",
+        "nodes",
+        metavar="NODE",
+        multiple=True,
+        help="Only read records of this node, can be repeated.  [default: all]",
+    )(f)
+    return f
+
+
+def jobs_option(f):
+    """Add the --jobs option to decode the PFB blocks in parallel."""
+    return click.option(
+        "-j",
+        "--jobs",
+        type=click.IntRange(min=1),
+        default=1,
+        help="Decode the PFB in this many processes, only for local files."
+        "  [default: 1]",
+    )(f)
+
+
+def import_options(f):
+    """Add the options to order and parse the input files of the importers."""
+    f = click.option(
+        "-p",
+        "--parse-jobs",
+        type=click.IntRange(min=1),
+        default=1,
+        help="Parse this many input files at once in worker processes."
+        "  [default: 1]",
+    )(f)
+    f = click.option(
+        "--order",
+        type=click.Choice(ORDERS),
+        default=ORDERS[0],
+        help="Order of the input files: as listed, by node name, or the nodes after"
+        " the nodes they link to.  [default: {}]".format(ORDERS[0]),
+    )(f)
+    return f
+
+
+def manifest_option(f):
+    """Add the --manifest option to embed the record counts in the written PFB."""
+    return click.option(
+        "--manifest",
+        is_flag=True,
+        help="Embed the record and edge counts of the nodes into the PFB header,"
+        " needs a seekable output.",
+    )(f)
+
+
+def writer_options(codec=True):
+    """Add the options to tune the blocks of the written PFB.
+
+    The --codec option is left out for commands appending to an existing PFB file,
+    whose codec cannot change.
+    """
+
+    def decorator(f):
+        f = click.option(
+            "--block-size",
+            type=click.IntRange(min=1),
+            default=SYNC_INTERVAL,
+            help="Uncompressed byte size of the Avro blocks."
+            "  [default: {}]".format(SYNC_INTERVAL),
+        )(f)
+        f = click.option(
+            "--level",
+            type=int,
+            help="Compression level of the codec.  [default: codec default]",
+        )(f)
+        if codec:
+            f = click.option(
+                "--codec",
+                type=click.Choice(CODECS + tuple(CODEC_ALIASES)),
+                help="Avro codec to compress the blocks with.  [default: the codec"
+                " of the input PFB, or null]",
+            )(f)
+        return f
+
+    return decorator
+
+
+def make_projection(nodes, fields):
+    """Convert the --node and --field options into PFBReader keyword arguments."""
+    projection = {}
+    by_node = {}
+    for field in fields:
+        node, sep, name = field.partition(".")
+        if not sep or not node or not name:
+            raise click.BadParameter(
+                "expected NODE.FIELD, got {}".format(field), param_hint="--field"
+            )
+        by_node.setdefault(node, []).append(name)
+    if nodes or by_node:
+        projection["nodes"] = set(nodes) | set(by_node)
+    if by_node:
+        projection["fields"] = by_node
+    return projection
+
+
 @click.group()
 def main():
     """PFB: Portable Format for Biomedical Data."""
@@ -37,11 +149,27 @@ def main():
     default="-",
     help="The output PFB file.  [default: <stdout>]",
 )
+@manifest_option
+@writer_options()
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Encode the PFB blocks in this many processes.  [default: 1]",
+)
 @click.pass_context
-def from_command(ctx, output):
+def from_command(ctx, output, manifest, codec, level, block_size, jobs):
     """Generate PFB from other data formats."""
     ctx.ensure_object(dict)
-    ctx.obj["writer"] = PFBWriter(output)
+    ctx.obj["writer"] = PFBWriter(
+        output,
+        manifest=manifest,
+        codec=codec,
+        codec_compression_level=level,
+        sync_interval=block_size,
+        parallel=jobs,
+    )
 
 
 @main.group("to")
@@ -53,11 +181,14 @@ def from_command(ctx, output):
     default="-",
     help="The input PFB file.  [default: <stdin>]",
 )
+@jobs_option
 @click.pass_context
-def to_command(ctx, input_file):
+def to_command(ctx, input_file, jobs):
     """Convert PFB into other data formats."""
     ctx.ensure_object(dict)
-    ctx.obj["reader"] = PFBReader(input_file)
+    ctx.obj["input_file"] = input_file
+    ctx.obj["jobs"] = jobs
+    ctx.obj["reader"] = PFBReader(input_file, parallel=jobs)
 
 
 # Load plug-ins from entry_points (syntax changes for python 3.12+)
@@ -0,0 +1,111 @@
+"""Columnar batches of PFB records, see :meth:`pfb.reader.PFBReader.iter_batches`.
+
+Columns of ``long``, ``double`` and ``boolean`` fields are NumPy arrays if NumPy is
+installed, masked where values are null, and enum columns hold the index of each
+symbol in the enum, or -1 for null.
+"""
+
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# columns: field name -> values, including "id" and "relations"
+# symbols: enum field name -> symbols indexed by the values of the column
+Batch = namedtuple("Batch", ["name", "columns", "symbols"])
+
+DTYPES = {
+    "int": "int64",
+    "long": "int64",
+    "float": "float64",
+    "double": "float64",
+    "boolean": "bool",
+}
+
+
+def _column_type(t):
+    """Return the type of the values of a field, ignoring null, or None if mixed."""
+    if isinstance(t, list):
+        branches = [branch for branch in t if branch != "null"]
+        return _column_type(branches[0]) if len(branches) == 1 else None
+    if isinstance(t, dict) and t["type"] == "enum":
+        return t
+    if isinstance(t, dict) and t["type"] in DTYPES:
+        return t["type"]
+    return t if t in DTYPES else None
+
+
+def _array(values, dtype):
+    if numpy is None:
+        return values
+    if None not in values:
+        return numpy.array(values, dtype=dtype)
+    mask = [value is None for value in values]
+    filled = [False if value is None else value for value in values]
+    return numpy.ma.masked_array(numpy.array(filled, dtype=dtype), mask=mask)
+
+
+class ColumnBuilder(object):
+    """Accumulate records of a node into columns.
+
+    ``node`` is the decoded schema of the node, and ``tables`` its enum decode plan
+    ``{field name: {encoded symbol: decoded symbol}}``: records are expected with
+    their enum values still encoded.
+    """
+
+    def __init__(self, node, tables):
+        self.name = node["name"]
+        self.symbols = {}
+        # (field name, dtype or None, {encoded symbol: index or decoded symbol})
+        self._fields = []
+        for field in node["fields"]:
+            t = _column_type(field["type"])
+            table = tables.get(field["name"])
+            if isinstance(t, dict):
+                symbols = self.symbols[field["name"]] = t["symbols"]
+                index = {symbol: i for i, symbol in enumerate(symbols)}
+                table = {encoded: index[decoded] for encoded, decoded in table.items()}
+                self._fields.append((field["name"], "enum", table))
+            else:
+                self._fields.append((field["name"], DTYPES.get(t), table))
+        self._reset()
+
+    def _reset(self):
+        self._ids = []
+        self._relations = []
+        self._values = [[] for _ in self._fields]
+
+    def __len__(self):
+        return len(self._ids)
+
+    def append(self, record):
+        obj = record["object"]
+        self._ids.append(record["id"])
+        self._relations.append(record.get("relations"))
+        for (name, _, _), values in zip(self._fields, self._values):
+            values.append(obj.get(name))
+
+    def build(self):
+        """Return the batch of the records appended so far, and start a new one."""
+        columns = {"id": self._ids, "relations": self._relations}
+        for (name, dtype, table), values in zip(self._fields, self._values):
+            if dtype == "enum":
+                values = [-1 if v is None else table[v] for v in values]
+                if numpy is not None:
+                    values = numpy.array(values, dtype="int64")
+            elif dtype is not None:
+                values = _array(values, dtype)
+            elif table:
+                values = [
+                    (
+                        [table.get(e, e) for e in v]
+                        if isinstance(v, list)
+                        else table.get(v, v) if isinstance(v, str) else v
+                    )
+                    for v in values
+                ]
+            columns[name] = values
+        self._reset()
+        return Batch(self.name, columns, self.symbols)
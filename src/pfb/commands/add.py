@@ -4,7 +4,7 @@ import sys
 import click
 
 from ..base import str_hook
-from ..cli import main
+from ..cli import main, writer_options
 from ..reader import PFBReader
 from ..writer import PFBWriter
 
@@ -53,8 +53,9 @@ def make(name, path):
     help="The JSON file to add.  [default: <stdin>]",
 )
 @click.argument("pfb_file", metavar="PFB", type=click.File("a+b"))
+@writer_options(codec=False)
 @_make_add_guide
-def add(json_file, pfb_file):
+def add(json_file, pfb_file, level, block_size):
     """Add records from a minified JSON file to the PFB file."""
 
     def data():
@@ -64,7 +65,9 @@ def add(json_file, pfb_file):
     pos = pfb_file.tell()
     pfb_file.seek(0)
     with PFBReader(pfb_file) as reader:
-        with PFBWriter(pfb_file) as writer:
+        with PFBWriter(
+            pfb_file, codec_compression_level=level, sync_interval=block_size
+        ) as writer:
             writer.copy_schema(reader)
             pfb_file.seek(pos)
             writer.write(data(), metadata=False)
@@ -0,0 +1,30 @@
+import click
+
+from ..cli import main
+from ..reader import PFBReader
+
+
+@main.command(short_help="Write the block index of a PFB file.")
+@click.argument("path", metavar="PFB", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "-o",
+    "--output",
+    metavar="FILENAME",
+    type=click.Path(dir_okay=False, writable=True),
+    help="The index file.  [default: <PFB>.pfbidx]",
+)
+def index(path, output):
+    """Write a sidecar block index of the PFB file.
+
+    For each Avro block, the index records its byte offset, the record count and the
+    nodes present in it, so that records of a few nodes can be read without decoding
+    the whole file.
+    """
+    try:
+        with PFBReader(path) as reader:
+            output = reader.write_index(output)
+    except Exception:
+        click.secho("Failed!", fg="red", bold=True, err=True)
+        raise
+    click.secho("Done, created index at: ", fg="green", err=True, nl=False, bold=True)
+    click.secho(output, fg="white", err=True, bold=True)
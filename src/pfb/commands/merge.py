@@ -0,0 +1,44 @@
+from contextlib import ExitStack
+
+import click
+
+from ..cli import main, writer_options
+from ..reader import PFBReader
+from ..writer import PFBWriter
+
+
+@main.command(short_help="Merge PFB files into one.")
+@click.option(
+    "-o",
+    "--output",
+    metavar="FILENAME",
+    type=click.File("wb"),
+    default="-",
+    help="The merged PFB file.  [default: <stdout>]",
+)
+@writer_options()
+@click.argument(
+    "pfb_files", metavar="PFB...", nargs=-1, required=True, type=click.File("rb")
+)
+def merge(output, codec, level, block_size, pfb_files):
+    """Merge the PFB files into one, keeping the metadata of the first one.
+
+    If the PFB files have the same schema and codec, their blocks are copied without
+    decoding the records. Otherwise their schemas can only differ by the nodes they
+    have, and the records are decoded and written again.
+    """
+    try:
+        with ExitStack() as stack:
+            readers = [stack.enter_context(PFBReader(f)) for f in pfb_files]
+            with PFBWriter(
+                output,
+                codec=codec,
+                codec_compression_level=level,
+                sync_interval=block_size,
+            ) as writer:
+                writer.merge(readers)
+    except Exception:
+        click.secho("Failed!", fg="red", bold=True, err=True)
+        raise
+    else:
+        click.secho("Done!", fg="green", err=True, bold=True)
@@ -1,6 +1,6 @@
 import click
 
-from ..cli import main
+from ..cli import main, manifest_option, writer_options
 from ..reader import PFBReader
 from ..writer import PFBWriter
 
@@ -24,12 +24,29 @@ from ..writer import PFBWriter
     default="-",
     help="Destination PFB file.  [default: <stdout>]",
 )
+@manifest_option
+@writer_options()
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Decode and encode the PFB in this many processes, only decoding local"
+    " files.  [default: 1]",
+)
 @click.pass_context
-def rename(ctx, input_file, output_file):
+def rename(ctx, input_file, output_file, manifest, codec, level, block_size, jobs):
     """Rename different parts of schema."""
     ctx.ensure_object(dict)
-    ctx.obj["reader"] = PFBReader(input_file)
-    ctx.obj["writer"] = PFBWriter(output_file)
+    ctx.obj["reader"] = PFBReader(input_file, parallel=jobs)
+    ctx.obj["writer"] = PFBWriter(
+        output_file,
+        manifest=manifest,
+        codec=codec,
+        codec_compression_level=level,
+        sync_interval=block_size,
+        parallel=jobs,
+    )
 
 
 @rename.command("node", short_help="Rename node.")
@@ -41,9 +58,8 @@ def node_command(ctx, old, new):
     try:
         with ctx.obj["reader"] as reader, ctx.obj["writer"] as writer:
             writer.copy_schema(reader)
-            writer.prepare_encode_cache()
             writer.rename_node(old.encode("utf-8"), new.encode("utf-8"))
-            writer.write(reader)
+            writer.copy_records(reader)
     except Exception:
         click.secho("Failed!", fg="red", bold=True, err=True)
         raise
@@ -69,9 +85,8 @@ def enum_command(ctx, field, old, new):
     try:
         with ctx.obj["reader"] as reader, ctx.obj["writer"] as writer:
             writer.copy_schema(reader)
-            writer.prepare_encode_cache()
             writer.rename_enum(field, old.encode("utf-8"), new.encode("utf-8"))
-            writer.write(reader)
+            writer.copy_records(reader)
     except Exception:
         click.secho("Failed!", fg="red", bold=True, err=True)
         raise
@@ -4,8 +4,9 @@ import sys
 
 import click
 
-from ..cli import main
+from ..cli import jobs_option, main, make_projection, projection_options
 from ..reader import PFBReader
+from ..stats import collect_stats
 
 
 @main.group(
@@ -25,14 +26,20 @@ from ..reader import PFBReader
     type=int,
     help="How many records to show, ignored for sub-commands.  [default: no limit]",
 )
+@projection_options
+@jobs_option
 @click.pass_context
-def show(ctx, input_file, limit):
+def show(ctx, input_file, limit, nodes, fields, jobs):
     """Show records of the PFB file.
 
-    Specify a sub-command to show other information.
+    Specify a sub-command to show other information. Use --node and --field to only
+    decode the records and fields of interest.
     """
     ctx.ensure_object(dict)
-    ctx.obj["reader"] = PFBReader(input_file)
+    ctx.obj["input_file"] = input_file
+    ctx.obj["reader"] = PFBReader(
+        input_file, parallel=jobs, **make_projection(nodes, fields)
+    )
     if ctx.invoked_subcommand is None:
         with ctx.obj["reader"] as reader:
             for r in itertools.islice(reader, limit):
@@ -108,22 +115,34 @@ def metadata(ctx, name):
 def stats(ctx, name):
     """Show the stats of the nodes in the PFB file.
 
-    the whole stats will be shown.
+    If NODE is specified, only the stats of the NODE will be shown, otherwise the
+    whole stats will be shown. Only node names and relations are decoded. Block bytes
+    are shared among the nodes in a block by their number of records.
     """
-    with ctx.obj["reader"] as reader:
-        stats = {}
-        edges = 0
-        for r in reader:
-            if r["name"] in stats:
-                stats[r["name"]] += 1
-            else:
-                stats[r["name"]] = 1
-
-            edges += len(r["relations"])
-
-        sys.stdout.write("Total number of nodes: " + str(len(stats)) + "\n")
-
-        sys.stdout.write("Total number of edges: " + str(edges) + "\n")
-
-        for key in stats:
-            sys.stdout.write(key + ": " + str(stats[key]) + "\n")
+    with ctx.obj["input_file"] as f:
+        stats = collect_stats(f)
+
+    nodes = stats["nodes"]
+    if name:
+        nodes = {name: nodes[name]} if name in nodes else {}
+    else:
+        sys.stdout.write("Total number of nodes: " + str(len(nodes)) + "\n")
+        sys.stdout.write("Total number of edges: " + str(stats["edges"]) + "\n")
+
+    for key in nodes:
+        sys.stdout.write(key + ": " + str(nodes[key]["records"]) + "\n")
+
+    if not name:
+        sys.stdout.write("Codec: " + stats["codec"] + "\n")
+        sys.stdout.write("Total number of blocks: " + str(stats["blocks"]) + "\n")
+        sys.stdout.write(
+            "Total block bytes: {} compressed, {} uncompressed\n".format(
+                stats["compressed_bytes"], stats["uncompressed_bytes"]
+            )
+        )
+    for key in nodes:
+        sys.stdout.write(
+            "{} bytes: {} compressed, {} uncompressed\n".format(
+                key, nodes[key]["compressed_bytes"], nodes[key]["uncompressed_bytes"]
+            )
+        )
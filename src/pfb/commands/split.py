@@ -0,0 +1,72 @@
+import os
+
+import click
+
+from ..cli import main
+from ..writer import split
+
+
+@main.command("split", short_help="Split a PFB file into smaller ones.")
+@click.option(
+    "-i",
+    "--input",
+    "input_file",
+    metavar="FILENAME",
+    type=click.File("rb"),
+    default="-",
+    help="The PFB file to split.  [default: <stdin>]",
+)
+@click.option(
+    "--by-node", is_flag=True, help="Write the records of each node into NODE.avro."
+)
+@click.option(
+    "--max-records",
+    type=click.IntRange(min=1),
+    help="Maximum number of records of each shard.",
+)
+@click.option(
+    "--max-bytes",
+    type=click.IntRange(min=1),
+    help="Maximum byte size of each shard, unless a single block is larger.",
+)
+@click.argument("output", default="./shards/", type=click.Path(file_okay=False))
+def split_command(input_file, by_node, max_records, max_bytes, output):
+    """Split the PFB file into PFB files under OUTPUT.
+
+    Each shard has the schema and metadata of the PFB file, and holds the records of
+    one node with --by-node, or at most --max-records records and --max-bytes bytes
+    otherwise, named 00000.avro, 00001.avro, etc. Blocks of records are copied
+    without decoding them where possible.
+
+    The default OUTPUT is ./shards/.
+    """
+    if by_node == bool(max_records or max_bytes):
+        raise click.UsageError(
+            "Use either --by-node, or --max-records and/or --max-bytes."
+        )
+    if not os.path.exists(output):
+        os.mkdir(output)
+
+    def _open(key):
+        name = key if by_node else "{:05d}".format(key)
+        return open(os.path.join(output, name + ".avro"), "wb")
+
+    try:
+        keys = split(
+            input_file,
+            _open,
+            by_node=by_node,
+            max_records=max_records,
+            max_bytes=max_bytes,
+        )
+    except Exception:
+        click.secho("Failed!", fg="red", bold=True, err=True)
+        raise
+    click.secho(
+        "Done, created %d files under: " % len(keys),
+        fg="green",
+        err=True,
+        nl=False,
+        bold=True,
+    )
+    click.secho(output, fg="white", err=True, bold=True)
@@ -0,0 +1,188 @@
+"""Block-level access to the Avro object container files PFB is stored in.
+
+An Avro container file is a header (magic, metadata map, sync marker) followed by
+blocks, each framed as ``<record count><byte size><data><sync marker>``. Since every
+block ends with the same sync marker, a header followed by any subset of the blocks
+of the same file is still a valid container, which is what :class:`BlockStream`
+builds for fastavro.
+"""
+
+import mmap
+from collections import namedtuple
+
+MAGIC = b"Obj\x01"
+SYNC_SIZE = 16
+
+Header = namedtuple("Header", ["meta", "sync", "size", "raw"])
+RawBlock = namedtuple("RawBlock", ["offset", "count", "size", "data"])
+
+
+class _Recorder(object):
+    """Wrap a file object to keep a copy of everything read through it."""
+
+    def __init__(self, fo):
+        self._fo = fo
+        self.chunks = []
+
+    def read(self, n):
+        rv = self._fo.read(n)
+        self.chunks.append(rv)
+        return rv
+
+
+def _read_exactly(fo, n):
+    rv = fo.read(n)
+    if len(rv) != n:
+        raise EOFError("Unexpected end of Avro file")
+    return rv
+
+
+def read_long(fo):
+    """Read a zig-zag encoded variable-length long, raise EOFError at end of file."""
+    c = fo.read(1)
+    if not c:
+        raise EOFError
+    b = ord(c)
+    n = b & 0x7F
+    shift = 7
+    while b & 0x80:
+        b = ord(_read_exactly(fo, 1))
+        n |= (b & 0x7F) << shift
+        shift += 7
+    return (n >> 1) ^ -(n & 1)
+
+
+def encode_long(n):
+    """Encode the integer as a zig-zag variable-length long."""
+    n = (n << 1) ^ (n >> 63)
+    rv = bytearray()
+    while n & ~0x7F:
+        rv.append((n & 0x7F) | 0x80)
+        n >>= 7
+    rv.append(n)
+    return bytes(rv)
+
+
+def read_header(fo):
+    """Read the container header from the current position of the file object."""
+    recorder = _Recorder(fo)
+    if _read_exactly(recorder, len(MAGIC)) != MAGIC:
+        raise ValueError("Not an Avro container file")
+    meta = {}
+    while True:
+        count = read_long(recorder)
+        if count == 0:
+            break
+        if count < 0:
+            # negative count is followed by the byte size of the map block
+            count = -count
+            read_long(recorder)
+        for _ in range(count):
+            key = _read_exactly(recorder, read_long(recorder)).decode("utf-8")
+            meta[key] = _read_exactly(recorder, read_long(recorder))
+    sync = _read_exactly(recorder, SYNC_SIZE)
+    raw = b"".join(recorder.chunks)
+    return Header(meta, sync, len(raw), raw)
+
+
+def read_block(fo, offset, sync, read_data=True):
+    """Read the framed block at the current position of the file object.
+
+    ``offset`` is only reported back in the block, the file object is expected to
+    be positioned there already. Raise EOFError if there are no more blocks.
+    """
+    recorder = _Recorder(fo)
+    count = read_long(recorder)
+    data_size = read_long(recorder)
+    framing = sum(len(c) for c in recorder.chunks)
+    if read_data:
+        data = _read_exactly(fo, data_size)
+    else:
+        data = None
+        fo.seek(data_size, 1)
+    if _read_exactly(fo, SYNC_SIZE) != sync:
+        raise ValueError("Sync marker mismatch in block at offset %d" % offset)
+    return RawBlock(offset, count, framing + data_size + SYNC_SIZE, data)
+
+
+def iter_blocks(fo, header, read_data=True):
+    """Iterate the raw, still compressed blocks following the header."""
+    offset = header.size
+    while True:
+        try:
+            block = read_block(fo, offset, header.sync, read_data=read_data)
+        except EOFError:
+            return
+        yield block
+        offset += block.size
+
+
+def map_file(f):
+    """Memory-map the whole file for reading, return None if it cannot be mapped."""
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        # no file descriptor, or an empty file
+        return None
+    if hasattr(mapped, "madvise"):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    return mapped
+
+
+def frame_block(count, data, sync):
+    """Return the bytes of a block holding ``count`` records of encoded ``data``."""
+    return b"".join([encode_long(count), encode_long(len(data)), data, sync])
+
+
+class BlockStream(object):
+    """A read-only file object over a sequence of byte chunks.
+
+    The chunks are pulled lazily from the iterable, so a header followed by the
+    framed blocks of interest can be streamed to fastavro without reading the rest
+    of the file. Once the chunks are exhausted, reads are passed on to the ``tail``
+    file object if given, e.g. the rest of a file whose header was already read.
+    """
+
+    def __init__(self, chunks, tail=None):
+        self._chunks = iter(chunks)
+        self._tail = tail
+        self._current = b""
+        self._pos = 0
+        self._offset = 0
+
+    def tell(self):
+        return self._offset
+
+    def read(self, n=-1):
+        rv = self._read(n)
+        self._offset += len(rv)
+        return rv
+
+    def _read(self, n):
+        if n is None or n < 0:
+            rv = [self._current[self._pos :]]
+            rv.extend(self._chunks)
+            if self._tail is not None:
+                rv.append(self._tail.read())
+            self._current = b""
+            self._pos = 0
+            return b"".join(rv)
+        parts = []
+        while n > 0:
+            available = len(self._current) - self._pos
+            if available <= 0:
+                self._current = next(self._chunks, None)
+                self._pos = 0
+                if self._current is None:
+                    self._current = b""
+                    if self._tail is not None:
+                        parts.append(self._tail.read(n))
+                    break
+                continue
+            take = min(n, available)
+            parts.append(self._current[self._pos : self._pos + take])
+            self._pos += take
+            n -= take
+        if len(parts) == 1:
+            return bytes(parts[0])
+        return b"".join(parts)
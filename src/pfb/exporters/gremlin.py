@@ -1,11 +1,17 @@
 import csv
 import gzip
+import io
+import json
 import os
-from uuid import uuid4
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from uuid import NAMESPACE_URL, uuid4, uuid5
 
 import click
 
 from ..cli import to_command
+from ..container import iter_blocks, read_header
+from ..reader import PFBReader
 
 TYPE_MAPPING = dict(
     boolean="Boolean",
@@ -20,6 +26,15 @@ TYPE_MAPPING = dict(
     double="Double",
 )
 
+# namespace of the ids derived from the node names and record ids by --stable-ids
+ID_NAMESPACE = uuid5(NAMESPACE_URL, "https://github.com/uc-cdis/pypfb")
+
+# CSV text compressed at once, as a gzip member of the file
+CHUNK_SIZE = 1024 * 1024
+
+# the Neptune bulk load manifest written by --manifest
+MANIFEST_NAME = "manifest.json"
+
 
 @to_command.command("gremlin", short_help="Convert PFB to Neptune (gremlin).")
 @click.argument("output", default="./gremlin/", type=click.Path(file_okay=False))
@@ -29,24 +44,61 @@ TYPE_MAPPING = dict(
     default=True,
     help="Whether gzip the output.  [default: yes]",
 )
+@click.option(
+    "--stable-ids/--random-ids",
+    default=False,
+    help="Derive the vertex and edge ids from the node names and record ids, "
+    "instead of random ids.  [default: random]",
+)
+@click.option(
+    "--max-file-size",
+    type=click.IntRange(min=1),
+    help="Roll the CSV files past this many MB of CSV text, into NAME.0000.csv, "
+    "NAME.0001.csv, etc.  [default: no limit]",
+)
+@click.option(
+    "--threads",
+    type=click.IntRange(min=1),
+    default=4,
+    help="Compress the CSV files in this many threads.  [default: 4]",
+)
+@click.option(
+    "--manifest",
+    is_flag=True,
+    help="Write the list of the CSV files into {}, vertices first.".format(
+        MANIFEST_NAME
+    ),
+)
 @click.pass_context
-def to_gremlin(ctx, output, gzipped):
+def to_gremlin(ctx, output, gzipped, stable_ids, max_file_size, threads, manifest):
     """Convert PFB into CSV files under OUTPUT for Neptune bulk load (Gremlin).
 
-    The default OUTPUT is ./gremlin/.
+    The default OUTPUT is ./gremlin/. With --stable-ids, exporting the same records
+    again gives the same ids, and the edges are written as their records are read
+    instead of being kept in memory until their destination vertex is seen.
+
+    With --stable-ids and -j greater than 1, a local PFB file is exported by that
+    many processes, each writing the CSV files of its share of the PFB blocks, named
+    NAME.part00.csv, NAME.part01.csv, etc.
     """
-    handlers_by_name = {}
+    max_size = max_file_size and max_file_size * 1024 * 1024
+    jobs = ctx.obj["jobs"]
+    path = getattr(ctx.obj["input_file"], "name", None)
     try:
-        with ctx.obj["reader"] as reader:
-            num_files = _to_gremlin(reader, output, gzipped, handlers_by_name)
+        if stable_ids and jobs and jobs > 1 and _is_local(path):
+            files = _parallel_gremlin(path, jobs, output, gzipped, max_size, threads)
+        else:
+            with ctx.obj["reader"] as reader:
+                with _CsvOutput(output, gzipped, max_size, threads) as out:
+                    _to_gremlin(reader, out, stable_ids)
+            files = out.files
+        if manifest:
+            write_manifest(output, files, gzipped)
     except Exception:
         click.secho("Failed!", fg="red", bold=True, err=True)
         raise
-    finally:
-        for f, w in list(handlers_by_name.values()):
-            f.close()
     click.secho(
-        "Done, created %d files under: " % num_files,
+        "Done, created %d files under: " % len(files),
         fg="green",
         err=True,
         nl=False,
@@ -55,81 +107,251 @@ def to_gremlin(ctx, output, gzipped):
     click.secho(output, fg="white", err=True, bold=True)
 
 
-def _to_gremlin(reader, dir_path, gzipped, handlers_by_name):
+def vertex_id(name, record_id):
+    """Return the stable id of the vertex of a record."""
+    return str(uuid5(ID_NAMESPACE, name + "/" + record_id))
+
+
+def edge_id(src_id, dst_id, label):
+    """Return the stable id of the edge between two vertex ids."""
+    return str(uuid5(ID_NAMESPACE, src_id + "/" + dst_id + "/" + label))
+
+
+class _CsvOutput(object):
+    """The CSV files of the Gremlin export, one per node plus one of the edges.
+
+    Rows are formatted into CSV text in memory, and the text is written in chunks
+    of CHUNK_SIZE characters. With gzip, each chunk is compressed as a gzip member
+    in a thread pool, and written in order once compressed, keeping a bounded number
+    of chunks in flight. With ``max_size``, a file is rolled into the next one once
+    it holds that many bytes of CSV text, and each file starts with the header row.
+    """
+
+    def __init__(self, dir_path, gzipped=True, max_size=None, threads=1, shard=None):
+        self.dir_path = dir_path
+        self.shard = shard
+        self.gzipped = gzipped
+        self.max_size = max_size
+        # the files in creation order, see write_manifest
+        self.files = []
+        self._streams = {}
+        self._chunk_size = min(CHUNK_SIZE, max_size or CHUNK_SIZE)
+        self._threads = threads
+        self._pool = ThreadPoolExecutor(threads) if gzipped else None
+        # (file, manifest entry, compressed chunk or None to close the file)
+        self._pending = deque()
+
+    def __enter__(self):
+        if not os.path.exists(self.dir_path):
+            os.makedirs(self.dir_path, exist_ok=True)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                for stream in self._streams.values():
+                    if stream.file is not None:
+                        self._flush(stream, close=True)
+                self._write_pending(0)
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True, cancel_futures=True)
+            for f, _, _ in self._pending:
+                f.close()
+            for stream in self._streams.values():
+                if stream.file is not None:
+                    stream.file.close()
+
+    def open(self, key, name, header_row, kind):
+        """Start the CSV files named NAME of a node, or of the edges."""
+        buffer = io.StringIO()
+        self._streams[key] = stream = _Stream(name, header_row, kind, buffer)
+        stream.writer = csv.writer(buffer)
+        self._next_file(stream)
+
+    def __contains__(self, key):
+        return key in self._streams
+
+    def writerow(self, key, row):
+        stream = self._streams[key]
+        if stream.file is None:
+            self._next_file(stream)
+        stream.writer.writerow(row)
+        stream.records += 1
+        if stream.buffer.tell() >= self._chunk_size:
+            self._flush(stream)
+
+    def _next_file(self, stream):
+        suffix = "" if self.shard is None else ".part{:02d}".format(self.shard)
+        if self.max_size is not None:
+            suffix += ".{:04d}".format(stream.index)
+        path = os.path.join(self.dir_path, stream.name + suffix + ".csv")
+        if self.gzipped:
+            path += ".gz"
+        click.secho("Creating ", fg="blue", err=True, nl=False)
+        click.secho(path, fg="white", err=True)
+        stream.file = open(path, "wb")
+        stream.entry = {
+            "path": os.path.basename(path),
+            "type": stream.kind,
+            "label": stream.name if stream.kind == "vertex" else None,
+            "records": 0,
+            "size": 0,
+        }
+        self.files.append(stream.entry)
+        stream.index += 1
+        stream.size = 0
+        stream.writer.writerow(stream.header_row)
+
+    def _flush(self, stream, close=False):
+        text = stream.buffer.getvalue()
+        stream.buffer.seek(0)
+        stream.buffer.truncate()
+        stream.size += len(text)
+        stream.entry["records"] += stream.records
+        stream.records = 0
+        data = text.encode()
+        if self._pool is not None:
+            data = self._pool.submit(gzip.compress, data)
+        self._pending.append((stream.file, stream.entry, data))
+        if close or (self.max_size and stream.size >= self.max_size):
+            # the next file is started with the next row
+            self._pending.append((stream.file, stream.entry, None))
+            stream.file = None
+        self._write_pending(2 * self._threads)
+
+    def _write_pending(self, size):
+        """Write the pending chunks in order until at most SIZE are left."""
+        while len(self._pending) > size:
+            f, entry, data = self._pending.popleft()
+            if data is None:
+                f.close()
+                continue
+            data = data if isinstance(data, bytes) else data.result()
+            f.write(data)
+            entry["size"] += len(data)
+
+
+def write_manifest(dir_path, files, gzipped=True):
+    """Write the list of the files, the vertices before the edges."""
+    manifest = {
+        "format": "csv",
+        "compression": "gzip" if gzipped else None,
+        "files": sorted(files, key=lambda entry: entry["type"] != "vertex"),
+    }
+    path = os.path.join(dir_path, MANIFEST_NAME)
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return path
+
+
+class _Stream(object):
+    """The state of the CSV files of a node, or of the edges, see _CsvOutput."""
+
+    def __init__(self, name, header_row, kind, buffer):
+        self.name = name
+        self.header_row = header_row
+        self.kind = kind
+        self.buffer = buffer
+        self.writer = None
+        self.file = None
+        self.entry = None
+        # index of the next file, CSV text in the current file, rows in the buffer
+        self.index = 0
+        self.size = 0
+        self.records = 0
+
+
+def _is_local(path):
+    return isinstance(path, str) and os.path.isfile(path)
+
+
+def _share_blocks(path, shares):
+    """Split the blocks of the PFB file into contiguous shares of similar sizes."""
+    with open(path, "rb") as f:
+        header = read_header(f)
+        f.seek(header.size)
+        blocks = [(b.offset, b.size) for b in iter_blocks(f, header, read_data=False)]
+    total = sum(size for _, size in blocks)
+    rv = [[]]
+    done = 0
+    for offset, size in blocks:
+        if done >= total * len(rv) / shares and len(rv) < shares:
+            rv.append([])
+        rv[-1].append((offset, size))
+        done += size
+    return [share for share in rv if share]
+
+
+def _export_share(path, blocks, dir_path, gzipped, max_size, threads, shard):
+    """Export the records of the blocks with stable ids, return the file entries."""
+    with PFBReader(path) as reader:
+        with _CsvOutput(dir_path, gzipped, max_size, threads, shard) as out:
+            _to_gremlin(reader, out, True, reader.iter_block_records(blocks))
+    return out.files
+
+
+def _parallel_gremlin(path, jobs, dir_path, gzipped, max_size, threads):
+    """Export shares of the blocks of a local PFB file in JOBS processes."""
+    shares = _share_blocks(path, jobs)
+    with ProcessPoolExecutor(len(shares)) as executor:
+        futures = [
+            executor.submit(
+                _export_share, path, blocks, dir_path, gzipped, max_size, threads, i
+            )
+            for i, blocks in enumerate(shares)
+        ]
+        return [entry for future in futures for entry in future.result()]
+
+
+def _to_gremlin(reader, out, stable_ids=False, records=None):
+    # with random ids, the vertex ids by (node name, record id) and the edges to
+    # vertices not seen yet
     uuids = {}
-    project_ids = []
     edges = []
-    num_files = 1  # the gremlin_egdes
-
-    if not os.path.exists(dir_path):
-        os.mkdir(dir_path)
-
-    path = os.path.join(dir_path, "gremlin_edges.csv")
-    open_func = open
-    if gzipped:
-        path += ".gz"
-        open_func = gzip.open
-    click.secho("Creating ", fg="blue", err=True, nl=False)
-    click.secho(path, fg="white", err=True)
-    f = open_func(path, "wt")
-    edge_writer = csv.writer(f)
-    edge_writer.writerow(["~id", "~from", "~to", "~label"])
-    handlers_by_name["~edges"] = f, edge_writer
+
+    out.open("~edges", "gremlin_edges", ["~id", "~from", "~to", "~label"], "edge")
 
     fields_by_name = {node["name"]: node["fields"] for node in reader.schema}
-    for row in reader:
+    field_names = {
+        name: [field["name"] for field in fields]
+        for name, fields in fields_by_name.items()
+    }
+    for row in reader if records is None else records:
         name = row["name"]
-        fields = fields_by_name[name]
-
-        row_id = row["id"]
         obj = row["object"]
-        relations = row["relations"]
-
-        # get the CSV writer for this row, create one if not created
-        pair = handlers_by_name.get(name)
-        if pair is None:
-            header_row = _make_header_row(fields)
-            path = os.path.join(dir_path, name + ".csv")
-            if gzipped:
-                path += ".gz"
-            click.secho("Creating ", fg="blue", err=True, nl=False)
-            click.secho(path, fg="white", err=True)
-            f = open_func(path, "wt")
-            num_files += 1
-            w = csv.writer(f)
-            w.writerow(header_row)
-            handlers_by_name[name] = f, w
-        else:
-            w = pair[1]
+
+        # start the CSV of the node if not started
+        if name not in out:
+            out.open(name, name, _make_header_row(fields_by_name[name]), "vertex")
 
         # write data into CSV
-        uuid = uuids[(name, row_id)] = str(uuid4())
-        row = [name, uuid]
-        for field in fields:
-            if field["name"] == "project_id":
-                project_ids.append([name, uuid, obj["project_id"]])
-                row.append(obj[field["name"]])
-            else:
-                value = obj[field["name"]]
-                row.append(value)
-        w.writerow(row)
+        if stable_ids:
+            uuid = vertex_id(name, row["id"])
+        else:
+            uuid = uuids[(name, row["id"])] = str(uuid4())
+        out.writerow(name, [name, uuid] + [obj[field] for field in field_names[name]])
 
         # write relations if possible, or store in memory for later
-        for relation in relations:
-            key = relation["dst_name"], relation["dst_id"]
+        for relation in row["relations"]:
+            label = relation["dst_name"]
+            if stable_ids:
+                to_uuid = vertex_id(label, relation["dst_id"])
+                out.writerow(
+                    "~edges", [edge_id(uuid, to_uuid, label), uuid, to_uuid, label]
+                )
+                continue
+            key = label, relation["dst_id"]
             to_uuid = uuids.get(key)
             if to_uuid is None:
                 edges.append((key, uuid))
             else:
-                edge_writer.writerow(
-                    [str(uuid4()), uuid, to_uuid, relation["dst_name"]]
-                )
+                out.writerow("~edges", [str(uuid4()), uuid, to_uuid, label])
 
-    click.secho("Writing remaining edges...", fg="cyan", err=True)
+    if edges:
+        click.secho("Writing remaining edges...", fg="cyan", err=True)
     for edge in edges:
-        edge_writer.writerow([str(uuid4()), edge[1], uuids[edge[0]], edge[0][0]])
-
-    return num_files
+        out.writerow("~edges", [str(uuid4()), edge[1], uuids[edge[0]], edge[0][0]])
 
 
 def _make_header_row(fields):
@@ -0,0 +1,182 @@
+import json
+import os
+
+import click
+
+from ..cli import make_projection, projection_options, to_command
+from ..reader import PFBReader
+from .tsv import PLURAL_PARENTS, make_relations_by_node
+
+COMPRESSIONS = ["none", "snappy", "gzip", "brotli", "zstd", "lz4"]
+
+
+@to_command.command("parquet", short_help="Convert PFB to Parquet.")
+@click.argument("output", default="./parquet/", type=click.Path(file_okay=False))
+@click.option(
+    "--row-group-size",
+    type=click.IntRange(min=1),
+    default=100000,
+    help="Number of records of each row group.  [default: 100000]",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(COMPRESSIONS),
+    default="snappy",
+    help="Compression codec of the Parquet files.  [default: snappy]",
+)
+@projection_options
+@click.pass_context
+def parquet(ctx, output, row_group_size, compression, nodes, fields):
+    """Convert PFB into one Parquet dataset per node under OUTPUT.
+
+    Each node is written into OUTPUT/NODE/part-0.parquet, with typed columns for the
+    node fields, and the "id" and "<link>.id" columns of the record and its parents.
+    The default OUTPUT is ./parquet/. This needs pyarrow to be installed.
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise click.ClickException(
+            "pyarrow is needed to write Parquet: pip install pypfb[parquet]"
+        )
+    projection = make_projection(nodes, fields)
+    if projection:
+        ctx.obj["reader"] = PFBReader(
+            ctx.obj["input_file"], parallel=ctx.obj["jobs"], **projection
+        )
+    try:
+        with ctx.obj["reader"] as reader:
+            num_files = _to_parquet(reader, output, row_group_size, compression)
+    except Exception:
+        click.secho("Failed!", fg="red", bold=True, err=True)
+        raise
+    click.secho(
+        "Done, created %d files under: " % num_files,
+        fg="green",
+        err=True,
+        nl=False,
+        bold=True,
+    )
+    click.secho(output, fg="white", err=True, bold=True)
+
+
+def _arrow_column(pa, t):
+    """Return the Arrow type of the Avro type, and a converter of the column values.
+
+    Nullable unions take the type of their other branch, and other unions, records
+    and maps are written as JSON strings.
+    """
+    if isinstance(t, list):
+        branches = [branch for branch in t if branch != "null"]
+        if len(branches) == 1:
+            return _arrow_column(pa, branches[0])
+        return _json_column(pa)
+    if isinstance(t, dict):
+        if t["type"] == "enum":
+            dictionary = pa.array(t["symbols"], pa.string())
+
+            def _enum(codes):
+                indices = pa.array(
+                    [None if code < 0 else code for code in codes], pa.int32()
+                )
+                return pa.DictionaryArray.from_arrays(indices, dictionary)
+
+            return pa.dictionary(pa.int32(), pa.string()), _enum
+        if t["type"] == "array":
+            item_type, _ = _arrow_column(pa, t["items"])
+            if pa.types.is_dictionary(item_type):
+                # arrays of enums are decoded into symbols
+                item_type = pa.string()
+            list_type = pa.list_(item_type)
+            return list_type, lambda values: pa.array(values, list_type)
+        if t["type"] in ("record", "map"):
+            return _json_column(pa)
+        return _arrow_column(pa, t["type"])
+    arrow_type = {
+        "string": pa.string(),
+        "bytes": pa.binary(),
+        "int": pa.int64(),
+        "long": pa.int64(),
+        "float": pa.float64(),
+        "double": pa.float64(),
+        "boolean": pa.bool_(),
+    }.get(t)
+    if arrow_type is None:
+        return _json_column(pa)
+
+    def _convert(values):
+        mask = getattr(values, "mask", None)
+        if mask is not None:
+            return pa.array(values.data, arrow_type, mask=mask)
+        return pa.array(values, arrow_type)
+
+    return arrow_type, _convert
+
+
+def _json_column(pa):
+    def _convert(values):
+        return pa.array(
+            [None if v is None else json.dumps(v) for v in values], pa.string()
+        )
+
+    return pa.string(), _convert
+
+
+def _compile_node(pa, node, relations):
+    """Return the Arrow schema of the node and the converters of its columns."""
+    fields = [pa.field("id", pa.string())]
+    converters = [("id", lambda values: pa.array(values, pa.string()))]
+    for field in node["fields"]:
+        arrow_type, convert = _arrow_column(pa, field["type"])
+        fields.append(pa.field(field["name"], arrow_type))
+        converters.append((field["name"], convert))
+    for columns in relations.values():
+        fields.append(pa.field(columns["id"], pa.string()))
+    return pa.schema(fields), converters
+
+
+def _parent_ids(relations, parents):
+    """Return the "<link>.id" columns of the records from their relations."""
+    columns = {columns["id"]: [None] * len(relations) for columns in parents.values()}
+    for i, record_relations in enumerate(relations):
+        for r in record_relations or ():
+            parent = PLURAL_PARENTS.get(r["dst_name"], r["dst_name"])
+            if parent in parents:
+                columns[parents[parent]["id"]][i] = r["dst_id"]
+    return columns
+
+
+def _to_parquet(reader, dir_path, row_group_size, compression):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if not os.path.exists(dir_path):
+        os.mkdir(dir_path)
+    relations_by_node = make_relations_by_node(reader.metadata)
+    nodes = {node["name"]: node for node in reader.schema}
+    writers = {}
+    try:
+        for batch in reader.iter_batches(batch_size=row_group_size):
+            name = batch.name
+            if name not in writers:
+                parents = relations_by_node.get(name, {})
+                schema, converters = _compile_node(pa, nodes[name], parents)
+                node_path = os.path.join(dir_path, name)
+                if not os.path.exists(node_path):
+                    os.mkdir(node_path)
+                path = os.path.join(node_path, "part-0.parquet")
+                click.secho("Creating ", fg="blue", err=True, nl=False)
+                click.secho(path, fg="white", err=True)
+                w = pq.ParquetWriter(path, schema, compression=compression)
+                writers[name] = w, schema, converters, parents
+            w, schema, converters, parents = writers[name]
+
+            arrays = [convert(batch.columns[field]) for field, convert in converters]
+            parent_ids = _parent_ids(batch.columns["relations"], parents)
+            for columns in parents.values():
+                arrays.append(pa.array(parent_ids[columns["id"]], pa.string()))
+            w.write_table(pa.Table.from_arrays(arrays, schema=schema))
+    finally:
+        for w, _, _, _ in writers.values():
+            w.close()
+    return len(writers)
@@ -1,10 +1,18 @@
 import csv
+import gzip
 import os
 import json
+import queue
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
 
 import click
 
-from ..cli import to_command
+from ..cli import make_projection, projection_options, to_command
+from ..idmap import DEFAULT_MEMORY_LIMIT, IdMap
+from ..reader import PFBReader
 
 PLURAL_PARENTS = {
     "subjects": "subject",
@@ -14,25 +22,82 @@ PLURAL_PARENTS = {
     "projects": "project",
 }
 
+# rows sent at once to the TSV writers, and batches queued for each writer
+BATCH_ROWS = 1000
+QUEUE_BATCHES = 8
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# --compress option -> file name suffix
+COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
 
 @to_command.command("tsv", short_help="Convert PFB to tsv.")
 @click.argument("output", default="./tsvs/", type=click.Path(file_okay=False))
+@click.option(
+    "--memory-limit",
+    type=click.IntRange(min=1),
+    default=DEFAULT_MEMORY_LIMIT // (1024 * 1024),
+    help="Keep at most about this many MB of parent submitter_ids in memory, "
+    "the others are kept in a temporary file.  [default: {}]".format(
+        DEFAULT_MEMORY_LIMIT // (1024 * 1024)
+    ),
+)
+@click.option(
+    "-w",
+    "--writers",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Write the TSV files in this many threads, or processes if -j is greater "
+    "than 1.  [default: 1]",
+)
+@click.option(
+    "--compress",
+    type=click.Choice(sorted(COMPRESSIONS)),
+    help="Compress the TSV files.  [default: none]",
+)
+@click.option(
+    "--max-rows-per-file",
+    type=click.IntRange(min=1),
+    help="Split the TSV of a node into files of at most this many rows, named "
+    "NODE.000.tsv, NODE.001.tsv, etc.  [default: no limit]",
+)
+@projection_options
 @click.pass_context
-def tsv(ctx, output):
+def tsv(ctx, output, memory_limit, writers, compress, max_rows_per_file, nodes, fields):
     """Convert PFB into TSVs yielding one TSV per node.
 
-    The default OUTPUT is ./tsvs/.
+    The default OUTPUT is ./tsvs/. Use --node and --field to only export some nodes
+    and fields. The "<link>.submitter_id" columns are resolved in a first pass over
+    the PFB, which is copied into a temporary file if it is not a local file. The
+    rows of each node are formatted, compressed and written by one of the --writers.
     """
-    handlers_by_name = {}
+    if compress == "zstd":
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            raise click.ClickException(
+                "zstandard is needed to compress with zstd: pip install pypfb[zstd]"
+            )
+    projection = make_projection(nodes, fields)
+    jobs = ctx.obj["jobs"]
     try:
-        with ctx.obj["reader"] as reader:
-            num_files = _to_tsv(reader, output, handlers_by_name)
+        with _local_input(ctx.obj["input_file"]) as path:
+            with PFBReader(path, parallel=jobs, **projection) as reader:
+                with IdMap(memory_limit * 1024 * 1024) as submitter_ids:
+                    _collect_submitter_ids(path, reader, submitter_ids, parallel=jobs)
+                    num_files = _to_tsv(
+                        reader,
+                        output,
+                        submitter_ids,
+                        writers=writers,
+                        processes=bool(jobs and jobs > 1),
+                        compress=compress,
+                        max_rows=max_rows_per_file,
+                    )
     except Exception:
         click.secho("Failed!", fg="red", bold=True, err=True)
         raise
-    finally:
-        for f, w in list(handlers_by_name.values()):
-            f.close()
     click.secho(
         "Done, created %d files under: " % num_files,
         fg="green",
@@ -43,20 +108,57 @@ def tsv(ctx, output):
     click.secho(output, fg="white", err=True, bold=True)
 
 
-node_submitter_ids = {}
+@contextmanager
+def _local_input(input_file):
+    """Yield the path of the input PFB, copying it into a temporary file if needed."""
+    name = getattr(input_file, "name", None)
+    if isinstance(name, str) and os.path.isfile(name):
+        yield name
+        return
+    fd, path = tempfile.mkstemp(prefix="pfb-", suffix=".avro")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(input_file, f, 1024 * 1024)
+        yield path
+    finally:
+        os.remove(path)
 
 
-def _to_tsv(reader, dir_path, handlers_by_name):
-    project_ids = []
-    num_files = 0
+def _collect_submitter_ids(path, reader, submitter_ids, parallel=None):
+    """Map the ids of the parents of the exported nodes to their submitter_id.
 
-    if not os.path.exists(dir_path):
-        os.mkdir(dir_path)
-
-    # Extract the relations information from the metadata and build a dictionary out of it with the information necessary to build the header
-    # eg: {"lab": {"case": {"id": "cases.id", "submitter_id": "cases.submitter_id"}}, "other node": {"other node parent link": {"id":"...", "submiter_id: "..."}}, ... }
-    relations_by_node = {}
+    Only the submitter_id field of the parent nodes is decoded.
+    """
+    exported = {node["name"] for node in reader.schema}
+    parents = set()
     for node in reader.metadata["nodes"]:
+        if node["name"] in exported:
+            parents.update(link["dst"] for link in node["links"])
+    fields = {}
+    for f in reader._encoded_schema["fields"]:
+        if f["name"] == "object":
+            for node in f["type"][1:]:
+                names = {field["name"] for field in node["fields"]}
+                if node["name"] in parents and "submitter_id" in names:
+                    fields[node["name"]] = ["submitter_id"]
+    if not fields:
+        return
+    with PFBReader(
+        path, nodes=set(fields), fields=fields, relations=False, parallel=parallel
+    ) as r:
+        for row in r:
+            submitter_id = row["object"]["submitter_id"]
+            if submitter_id is not None:
+                submitter_ids[row["id"]] = submitter_id
+
+
+def make_relations_by_node(metadata):
+    """Map the nodes to the relation columns of their parents, from the metadata.
+
+    e.g. {"lab": {"case": {"id": "cases.id", "submitter_id": "cases.submitter_id"}}}
+    """
+    relations_by_node = {}
+    for node in metadata["nodes"]:
         if node["name"] not in relations_by_node:
             relations_by_node[node["name"]] = {}
 
@@ -72,117 +174,209 @@ def _to_tsv(reader, dir_path, handlers_by_name):
                 relations_by_node[node["name"]][link["dst"]][
                     "submitter_id"
                 ] = name_submitter_id
+    return relations_by_node
 
-    fields_by_name = {node["name"]: node["fields"] for node in reader.schema}
 
-    # Add the relation fields to the lis of fields by node
-    for node_name, links in relations_by_node.items():
-        for linked_node_name, linked_values in links.items():
-            for attr_name, attr_value in linked_values.items():
-                if {
-                    "name": attr_value,
-                    "type": ["null", "string"],
-                } not in fields_by_name[node_name]:
-                    fields_by_name[node_name].append(
-                        {
-                            "name": attr_value,
-                            "type": ["null", "string"],
-                        }
-                    )
+def _compile_node(name, fields, parents, submitter_ids):
+    """Return the header row of the node and a function serializing its records.
 
-    for row in reader:
-        name = row["name"]
-        record_id = row["id"]
-        fields = fields_by_name[name]
+    ``fields`` are the fields of the node in the schema, ``parents`` its entry in
+    :func:`make_relations_by_node`, and ``submitter_ids`` maps the ids of the parent
+    records to their submitter_id. The columns are the node fields, then the
+    "<link>.id" and "<link>.submitter_id" columns of the parents, and the record id.
+    """
+    field_names = [field["name"] for field in fields]
+    link_columns = []
+    # parent node -> index of its "<link>.id" column in link_columns
+    slots = {}
+    for parent, columns in parents.items():
+        if columns["id"] in field_names or columns["id"] in link_columns:
+            continue
+        slots[parent] = len(link_columns)
+        link_columns.extend((columns["id"], columns["submitter_id"]))
+    for plural, parent in PLURAL_PARENTS.items():
+        if parent in slots:
+            slots.setdefault(plural, slots[parent])
+    header_row = ["type"] + field_names + link_columns + ["id"]
+    num_links = len(link_columns)
+
+    def serialize(row):
+        obj = row["object"]
+        links = [None] * num_links
+        for r in row["relations"]:
+            i = slots.get(r["dst_name"])
+            if i is not None:
+                links[i] = r["dst_id"]
+                links[i + 1] = submitter_ids.get(r["dst_id"], "null")
+        return (name, *map(obj.get, field_names), *links, row["id"])
 
-        node_index = next(
-            (
-                index
-                for (index, d) in enumerate(reader.metadata["nodes"])
-                if d["name"] == name
-            )
-        )
+    return header_row, serialize
 
-        obj = row["object"]
 
-        if "submitter_id" in obj:
-            node_submitter_ids[record_id] = obj["submitter_id"]
-
-        if {
-            "name": "id",
-            "type": ["null", "string"],
-        } not in fields:
-            fields.append(
-                {
-                    "name": "id",
-                    "type": ["null", "string"],
-                }
-            )
+def _write_tsvs(batches, errors):
+    """Write the batches of rows received from the queue, until None.
+
+    The first batch of each TSV file starts with its header row, and a None batch
+    closes the file. An error is put into the errors queue, and the following
+    batches are dropped so that the producer never blocks on a full queue.
+    """
+    # path -> (file, csv writer)
+    files = {}
+    try:
+        for path, rows in iter(batches.get, None):
+            if rows is None:
+                files.pop(path)[0].close()
+                continue
+            pair = files.get(path)
+            if pair is None:
+                f = _open_tsv(path)
+                pair = files[path] = f, csv.writer(f, delimiter="\t")
+            pair[1].writerows(rows)
+    except Exception as e:
+        errors.put(e)
+        for _ in iter(batches.get, None):
+            pass
+    finally:
+        for f, _ in files.values():
+            f.close()
 
-        obj["id"] = record_id
 
-        for r in row["relations"]:
-            parent_node = r["dst_name"]
-            parent_id = r["dst_id"]
-
-            if parent_node in PLURAL_PARENTS:
-                parent_node = PLURAL_PARENTS[parent_node]
-
-            if relations_by_node[name][parent_node]["id"]:
-                obj[relations_by_node[name][parent_node]["id"]] = r["dst_id"]
-
-            if relations_by_node[name][parent_node]["submitter_id"]:
-                if parent_id in node_submitter_ids:
-                    obj[
-                        relations_by_node[name][parent_node]["submitter_id"]
-                    ] = node_submitter_ids[parent_id]
-                else:
-                    obj[relations_by_node[name][parent_node]["submitter_id"]] = "null"
-
-        if "sample" in node_submitter_ids:
-            print(node_submitter_ids["sample"])
-
-        # get the TSV writer for this row, create one if not created
-        pair = handlers_by_name.get(name)
-        if pair is None:
-            header_row = _make_header_row(fields)
-            path = os.path.join(dir_path, name + ".tsv")
-            click.secho("Creating ", fg="blue", err=True, nl=False)
-            click.secho(path, fg="white", err=True)
-            f = open(path, "wt")
-            num_files += 1
-            w = csv.writer(f, delimiter="\t")
-            w.writerow(header_row)
-            handlers_by_name[name] = f, w
+def _open_tsv(path):
+    """Open the TSV file for writing, compressed according to its suffix."""
+    if path.endswith(COMPRESSIONS["gzip"]):
+        return gzip.open(path, "wt")
+    if path.endswith(COMPRESSIONS["zstd"]):
+        import zstandard
+
+        return zstandard.open(path, "wt")
+    return open(path, "wt", buffering=WRITE_BUFFER_SIZE)
+
+
+class _NodeWriters(object):
+    """Fan the rows out to the workers writing the TSV files.
+
+    Each TSV file is written by a single worker, thread or process, picked as the
+    one with the fewest rows sent so far when the first row of the file comes.
+    Rows are sent in batches over bounded queues, so that a slow worker blocks the
+    producer instead of buffering the rows in memory.
+    """
+
+    def __init__(self, workers=1, processes=False):
+        if processes:
+            import multiprocessing
+
+            make_queue, start = multiprocessing.Queue, multiprocessing.Process
         else:
-            w = pair[1]
-
-        # write data into TSV
-        data_row = [name]
-        for field in fields:
-            if field["name"] == "project_id":
-                project_ids.append([name, obj["project_id"]])
-                data_row.append(obj[field["name"]])
-            else:
-                # adding logic for multi-sample records that contain either project.submitter_id or samplie.submitter_id
-                if (
-                    field["name"] == "samples.id"
-                    or field["name"] == "projects.id"
-                    or field["name"] == "samples.submitter_id"
-                    or field["name"] == "projects.submitter_id"
-                ):
-                    if field["name"] not in obj:
-                        continue
-                value = obj[field["name"]] if field["name"] in obj else None
-                data_row.append(value)
-
-        w.writerow(data_row)
+            make_queue, start = queue.Queue, threading.Thread
+        self._errors = make_queue()
+        self._queues = [make_queue(QUEUE_BATCHES) for _ in range(workers)]
+        self._workers = [
+            start(target=_write_tsvs, args=(q, self._errors), daemon=True)
+            for q in self._queues
+        ]
+        for worker in self._workers:
+            worker.start()
+        self._sent = [0] * workers
+        # path -> [worker index, pending rows]
+        self._files = {}
+
+    def open(self, path, header_row):
+        i = self._sent.index(min(self._sent))
+        self._files[path] = [i, [header_row]]
+
+    def write(self, path, row):
+        pending = self._files[path]
+        pending[1].append(row)
+        if len(pending[1]) >= BATCH_ROWS:
+            self._send(path, pending)
+
+    def _send(self, path, pending):
+        if not self._errors.empty():
+            raise self._errors.get()
+        i, rows = pending
+        self._queues[i].put((path, rows))
+        self._sent[i] += len(rows)
+        pending[1] = []
+
+    def close_file(self, path):
+        """Send the pending rows of the file, and have its worker close it."""
+        pending = self._files.pop(path)
+        if pending[1]:
+            self._send(path, pending)
+        self._queues[pending[0]].put((path, None))
+
+    def close(self, flush=True):
+        """Send the pending rows, wait for the workers and raise their error."""
+        try:
+            if flush:
+                for path, pending in self._files.items():
+                    if pending[1]:
+                        self._send(path, pending)
+        finally:
+            for q in self._queues:
+                q.put(None)
+            for worker in self._workers:
+                worker.join()
+        if not self._errors.empty():
+            raise self._errors.get()
+
+
+def _tsv_path(dir_path, name, chunk=None, compress=None):
+    suffix = ".tsv" if chunk is None else ".{:03d}.tsv".format(chunk)
+    return os.path.join(dir_path, name + suffix + COMPRESSIONS.get(compress, ""))
+
+
+def _to_tsv(
+    reader,
+    dir_path,
+    submitter_ids,
+    writers=1,
+    processes=False,
+    compress=None,
+    max_rows=None,
+):
+    if not os.path.exists(dir_path):
+        os.mkdir(dir_path)
 
-    return num_files
+    relations_by_node = make_relations_by_node(reader.metadata)
+    fields_by_name = {node["name"]: node["fields"] for node in reader.schema}
+    # node name -> [serialize, header row, path, chunk index, rows in the chunk]
+    nodes = {}
+    num_files = 0
 
+    out = _NodeWriters(writers, processes)
+    try:
+        for row in reader:
+            name = row["name"]
+            state = nodes.get(name)
+            if state is None:
+                # first record of the node, compile its columns
+                header_row, serialize = _compile_node(
+                    name,
+                    fields_by_name[name],
+                    relations_by_node.get(name, {}),
+                    submitter_ids,
+                )
+                state = nodes[name] = [serialize, header_row, None, -1, 0]
+            elif max_rows and state[4] == max_rows:
+                out.close_file(state[2])
+                state[2] = None
+            if state[2] is None:
+                # create the TSV, or the next chunk of the TSV of the node
+                state[3] += 1
+                state[4] = 0
+                state[2] = _tsv_path(
+                    dir_path, name, state[3] if max_rows else None, compress
+                )
+                click.secho("Creating ", fg="blue", err=True, nl=False)
+                click.secho(state[2], fg="white", err=True)
+                out.open(state[2], state[1])
+                num_files += 1
+            out.write(state[2], state[0](row))
+            state[4] += 1
+    except BaseException:
+        out.close(flush=False)
+        raise
+    out.close()
 
-def _make_header_row(fields):
-    header_row = ["type"]
-    for field in fields:
-        header_row.append(field["name"])
-    return header_row
+    return num_files
@@ -0,0 +1,80 @@
+"""Mapping of record ids to values with a bounded memory use.
+
+Entries are kept in a dict until they take about ``memory_limit`` bytes, then they
+are moved into a temporary SQLite database, so that mapping every record of a large
+PFB file doesn't need as much RAM as the file has records.
+"""
+
+import os
+import sqlite3
+import tempfile
+
+# approximate size of an in-memory entry besides its strings: dict slot, str objects
+ENTRY_OVERHEAD = 150
+
+DEFAULT_MEMORY_LIMIT = 512 * 1024 * 1024
+
+
+class IdMap(object):
+    """Map strings to strings, spilling to a temporary SQLite file past the limit."""
+
+    def __init__(self, memory_limit=DEFAULT_MEMORY_LIMIT):
+        self.memory_limit = memory_limit
+        self._entries = {}
+        self._size = 0
+        self._path = None
+        self._db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __setitem__(self, key, value):
+        self._entries[key] = value
+        self._size += len(key) + len(value) + ENTRY_OVERHEAD
+        if self._size > self.memory_limit:
+            self._spill()
+
+    def get(self, key, default=None):
+        rv = self._entries.get(key)
+        if rv is not None:
+            return rv
+        if self._db is not None:
+            row = self._db.execute(
+                "SELECT value FROM ids WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                return row[0]
+        return default
+
+    @property
+    def spilled(self):
+        """Whether entries were moved to disk."""
+        return self._db is not None
+
+    def _spill(self):
+        if self._db is None:
+            fd, self._path = tempfile.mkstemp(prefix="pfb-ids-", suffix=".sqlite")
+            os.close(fd)
+            self._db = sqlite3.connect(self._path)
+            self._db.execute("PRAGMA journal_mode = OFF")
+            self._db.execute("PRAGMA synchronous = OFF")
+            self._db.execute(
+                "CREATE TABLE ids (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID"
+            )
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO ids VALUES (?, ?)", self._entries.items()
+            )
+        self._entries = {}
+        self._size = 0
+
+    def close(self):
+        self._entries = {}
+        self._size = 0
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            os.remove(self._path)
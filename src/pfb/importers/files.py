@@ -0,0 +1,257 @@
+"""Stream the records of the input files of the importers, in parallel if asked.
+
+Each input file holds the records of a single node, named after the file. The files
+are parsed one after the other in this process, or by worker processes which send
+the records back in batches over bounded queues, so that the memory use doesn't
+depend on the size of the files.
+"""
+
+import json
+import multiprocessing
+import os
+import queue
+import traceback
+
+import click
+
+# how the input files are ordered, see order_files
+ORDERS = ("listing", "name", "topological")
+
+# records sent at once by a worker process, and batches queued for each file
+BATCH_RECORDS = 1000
+QUEUE_BATCHES = 8
+
+# seconds to wait for a batch before checking that the worker process is alive
+POLL_INTERVAL = 1
+
+# characters read at once when parsing a JSON array incrementally
+CHUNK_SIZE = 1024 * 1024
+
+
+def node_of_file(path):
+    """Return the name of the node of an input file, its name without extension."""
+    return os.path.splitext(os.path.basename(path))[0].strip()
+
+
+def order_files(paths, metadata, order="listing"):
+    """Order the input files.
+
+    "listing" keeps the order of the paths, "name" sorts them by node name, and
+    "topological" puts the files of each node after the files of the nodes it links
+    to in the metadata, e.g. programs before projects before cases.
+    """
+    if order == "listing":
+        return list(paths)
+    if order == "name":
+        return sorted(paths, key=lambda p: (node_of_file(p), p))
+    if order != "topological":
+        raise ValueError("Unknown order: {}".format(order))
+
+    parents = {
+        node["name"]: sorted({link["dst"] for link in node["links"]})
+        for node in metadata["nodes"]
+    }
+    ranks = {}
+
+    def _rank(name, visiting=()):
+        if name not in ranks:
+            if name in visiting:
+                # a cycle, e.g. a node linking to itself
+                return 0
+            ranks[name] = 1 + max(
+                [_rank(p, visiting + (name,)) for p in parents.get(name, ())] or [-1]
+            )
+        return ranks[name]
+
+    return sorted(paths, key=lambda p: (_rank(node_of_file(p)), node_of_file(p), p))
+
+
+def iter_json(f, chunk_size=CHUNK_SIZE):
+    """Iterate the values of the JSON array in the file, or the single JSON value.
+
+    An array is parsed one value at a time, reading the file by chunks, so that it
+    doesn't need to fit in memory.
+    """
+    decoder = json.JSONDecoder()
+    buf = f.read(chunk_size)
+    pos = _skip_whitespace(buf, 0)
+    if buf[pos : pos + 1] != "[":
+        yield json.loads(buf + f.read())
+        return
+
+    pos += 1
+    # after "[" or ",", otherwise expecting "," or "]"
+    expect_value = True
+    while True:
+        pos = _skip_whitespace(buf, pos)
+        if pos == len(buf):
+            buf, pos = f.read(chunk_size), 0
+            if not buf:
+                raise ValueError("Unterminated JSON array")
+            continue
+        if buf[pos] == "]":
+            return
+        if not expect_value:
+            if buf[pos] != ",":
+                raise ValueError("Expected ',' or ']' in JSON array: " + buf[pos])
+            expect_value = True
+            pos += 1
+            continue
+
+        # decode the value, reading more while it may go on in the next chunk, e.g.
+        # a number is only complete once followed by a delimiter
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                error = None
+            except json.JSONDecodeError as e:
+                end, error = len(buf), e
+            if end < len(buf) and buf[end] in " \t\r\n,]":
+                break
+            more = f.read(chunk_size)
+            if not more:
+                if error is not None:
+                    raise error
+                break
+            buf, pos = buf[pos:] + more, 0
+        yield value
+        pos = end
+        expect_value = False
+
+
+def _skip_whitespace(buf, pos):
+    while pos < len(buf) and buf[pos] in " \t\r\n":
+        pos += 1
+    return pos
+
+
+def iter_ndjson(f):
+    """Iterate the JSON values of the file, one per line."""
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+def _produce(batches, parse, args):
+    """Send the records parsed from a file in batches, then their number.
+
+    An error is sent instead of the remaining batches, as a tuple of its type name,
+    message and traceback, as the error itself may not pickle.
+    """
+    count = 0
+    try:
+        batch = []
+        for record in parse(*args):
+            batch.append(record)
+            if len(batch) >= BATCH_RECORDS:
+                batches.put(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            batches.put(batch)
+            count += len(batch)
+    except Exception as e:
+        batches.put((type(e).__name__, str(e), traceback.format_exc()))
+        return
+    batches.put(count)
+
+
+def _received(path, batches, worker):
+    """Iterate the batches of records sent by the worker parsing the file.
+
+    Raise if the worker fails, dies, or if records were lost on the way.
+    """
+    count = 0
+    while True:
+        try:
+            batch = batches.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            if worker.is_alive():
+                continue
+            try:
+                # what the worker sent right before exiting
+                batch = batches.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                raise RuntimeError(
+                    "The worker parsing {} exited with code {}".format(
+                        path, worker.exitcode
+                    )
+                )
+        if isinstance(batch, tuple):
+            name, message, tb = batch
+            raise RuntimeError(
+                "Failed to parse {}: {}: {}\n\n{}".format(path, name, message, tb)
+            )
+        if isinstance(batch, int):
+            break
+        count += len(batch)
+        yield batch
+    worker.join()
+    if worker.exitcode != 0:
+        raise RuntimeError(
+            "The worker parsing {} exited with code {}".format(path, worker.exitcode)
+        )
+    if count != batch:
+        raise RuntimeError(
+            "Received {} of the {} records parsed from {}".format(count, batch, path)
+        )
+
+
+def iter_records(tasks, jobs=1):
+    """Iterate the records of the tasks, in order.
+
+    ``tasks`` is a list of ``(path, parse, args)``, where ``parse(*args)`` iterates
+    the records of the file at path. With ``jobs`` greater than 1, up to that many
+    files are parsed at once in worker processes, ahead of the file being read.
+    """
+    total = len(tasks)
+
+    def _progress(i, path):
+        click.secho("{}/{}: ".format(i + 1, total), fg="blue", nl=False, err=True)
+        click.secho(node_of_file(path), fg="white", err=True)
+
+    if jobs is None or jobs <= 1:
+        for i, (path, parse, args) in enumerate(tasks):
+            _progress(i, path)
+            for record in parse(*args):
+                yield record
+        return
+
+    # (queue, process) of the files being parsed, in order
+    running = []
+    pending = iter(tasks)
+
+    def _start():
+        for _, parse, args in pending:
+            batches = multiprocessing.Queue(QUEUE_BATCHES)
+            worker = multiprocessing.Process(
+                target=_produce, args=(batches, parse, args), daemon=True
+            )
+            worker.start()
+            running.append((batches, worker))
+            return
+
+    try:
+        for _ in range(jobs):
+            _start()
+        for i, (path, _, _) in enumerate(tasks):
+            _progress(i, path)
+            batches, worker = running[0]
+            for batch in _received(path, batches, worker):
+                for record in batch:
+                    yield record
+            running.pop(0)
+            _start()
+    finally:
+        for batches, worker in running:
+            worker.terminate()
+            worker.join()
+            _drain(batches)
+
+
+def _drain(batches):
+    try:
+        while True:
+            batches.get_nowait()
+    except (queue.Empty, OSError, ValueError):
+        pass
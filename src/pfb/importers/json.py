@@ -1,14 +1,14 @@
 from __future__ import absolute_import
 
 import glob
-import json
 import os
 
 import click
 
 from ..base import avro_record
-from ..cli import from_command
+from ..cli import from_command, import_options
 from ..reader import PFBReader
+from .files import iter_json, iter_ndjson, iter_records, node_of_file, order_files
 
 
 @from_command.command("json", short_help="Convert JSON files into a PFB file.")
@@ -22,14 +22,16 @@ from ..reader import PFBReader
 )
 @click.option("--program", required=True, help="Name of the program.")
 @click.option("--project", required=True, help="Name of the project.")
+@import_options
 @click.pass_context
-def from_json(ctx, path, schema, program, project):
+def from_json(ctx, path, schema, program, project, order, parse_jobs):
     """Convert JSON files under PATH into a PFB file.
 
     The JSON files are expected to be directly under PATH, and match "*.json". Each file
     should be a single JSON list of objects that matches the specified schema. Also, for
     now it is hard-coded that each object should contain at least the "submitter_id", or
-    it will be ignored.
+    it will be ignored. Files matching "*.ndjson" or "*.jsonl" hold one object per line.
+    The files are read incrementally, so they don't need to fit in memory.
     """
     try:
         with ctx.obj["writer"] as writer:
@@ -43,7 +45,9 @@ def from_json(ctx, path, schema, program, project):
             with PFBReader(schema) as reader:
                 writer.copy_schema(reader)
 
-            writer.write(_from_json(writer.metadata, path, program, project))
+            writer.write(
+                _from_json(writer.metadata, path, program, project, order, parse_jobs)
+            )
     except Exception:
         click.secho("Failed!", fg="red", bold=True, err=True)
         raise
@@ -51,31 +55,33 @@ def from_json(ctx, path, schema, program, project):
         click.secho("Done!", fg="green", err=True, bold=True)
 
 
-def _from_json(metadata, path, program, project):
+def _from_json(metadata, path, program, project, order="listing", jobs=1):
     link_dests = {
         node["name"]: {link["name"]: link["dst"] for link in node["links"]}
         for node in metadata["nodes"]
     }
 
-    order = glob.glob(os.path.join(path, "*.json"))
-
-    total = len(order)
-
-    for i, o in enumerate(order):
-        o = os.path.basename(o).replace(".json", "").strip()
-        click.secho("{}/{}: ".format(i + 1, total), fg="blue", nl=False, err=True)
-        click.secho(o, fg="white", err=True)
-
-        with open(os.path.join(path, o + ".json"), "r") as f:
-            json_data = json.load(f)
-
-        node_name = o
-
-        if isinstance(json_data, dict):
-            json_data = [json_data]
+    paths = [
+        p
+        for pattern in ("*.json", "*.ndjson", "*.jsonl")
+        for p in glob.glob(os.path.join(path, pattern))
+    ]
+    tasks = [
+        (p, _parse_json, (p, link_dests, program, project))
+        for p in order_files(paths, metadata, order)
+    ]
+    return iter_records(tasks, jobs)
+
+
+def _parse_json(path, link_dests, program, project):
+    node_name = node_of_file(path)
+    with open(path, "r") as f:
+        if path.endswith(".json"):
+            json_data = iter_json(f)
+        else:
+            json_data = iter_ndjson(f)
         for json_record in json_data:
-            record = convert_json(node_name, json_record, program, project, link_dests)
-            yield record
+            yield convert_json(node_name, json_record, program, project, link_dests)
 
 
 def convert_json(node_name, json_record, program, project, link_dests):
@@ -7,8 +7,9 @@ import csv
 import click
 
 from ..base import avro_record
-from ..cli import from_command
+from ..cli import from_command, import_options
 from ..reader import PFBReader
+from .files import iter_records, node_of_file, order_files
 
 
 @from_command.command("tsv", short_help="Convert TSV files into a PFB file.")
@@ -22,8 +23,9 @@ from ..reader import PFBReader
 )
 @click.option("--program", required=True, help="Name of the program.")
 @click.option("--project", required=True, help="Name of the project.")
+@import_options
 @click.pass_context
-def from_tsv(ctx, path, schema, program, project):
+def from_tsv(ctx, path, schema, program, project, order, parse_jobs):
     """Convert TSV files under PATH into a PFB file.
 
     The TSV files are expected to be directly under PATH, and match "*.tsv". Each file
@@ -44,7 +46,15 @@ def from_tsv(ctx, path, schema, program, project):
                 writer.copy_schema(reader)
 
             writer.write(
-                _from_tsv(writer.metadata, writer.schema, path, program, project)
+                _from_tsv(
+                    writer.metadata,
+                    writer.schema,
+                    path,
+                    program,
+                    project,
+                    order,
+                    parse_jobs,
+                )
             )
     except Exception:
         click.secho("Failed!", fg="red", bold=True, err=True)
@@ -53,35 +63,23 @@ def from_tsv(ctx, path, schema, program, project):
         click.secho("Done!", fg="green", err=True, bold=True)
 
 
-def _from_tsv(metadata, schema, path, program, project):
-    link_dests = {
-        node["name"]: {link["name"]: link["dst"] for link in node["links"]}
-        for node in metadata["nodes"]
-    }
-
-    order = glob.glob(os.path.join(path, "*.tsv"))
-
-    total = len(order)
-
-    for i, o in enumerate(order):
-        o = os.path.basename(o).replace(".tsv", "").strip()
-        click.secho("{}/{}: ".format(i + 1, total), fg="blue", nl=False, err=True)
-        click.secho(o, fg="white", err=True)
+def _from_tsv(metadata, schema, path, program, project, order="listing", jobs=1):
+    paths = order_files(glob.glob(os.path.join(path, "*.tsv")), metadata, order)
+    tasks = [(p, _parse_tsv, (p, schema, program, project)) for p in paths]
+    return iter_records(tasks, jobs)
 
-        tsv_data = list(
-            csv.DictReader(open(os.path.join(path, o + ".tsv")), delimiter="\t")
-        )
 
-        node_name = o
-
-        if isinstance(tsv_data, dict):
-            tsv_data = [tsv_data]
-        for tsv_record in tsv_data:
-            for k, v in tsv_record.items():
-                field_type = get_type_from_schema(schema, node_name, k)
-                tsv_record[k] = convert_types(v, field_type)
-            record = _convert_tsv(node_name, tsv_record, program, project, link_dests)
-            yield record
+def _parse_tsv(path, schema, program, project):
+    node_name = node_of_file(path)
+    with open(path) as f:
+        rows = csv.reader(f, delimiter="\t")
+        header = next(rows, None)
+        if header is None:
+            return
+        convert = make_row_converter(schema, node_name, header, program, project)
+        for row in rows:
+            if row:
+                yield convert(row)
 
 
 def convert_types(val, field_type):
@@ -138,50 +136,106 @@ def get_type_from_schema(schema, node, field):
     return field_type
 
 
-def _convert_tsv(node_name, tsv_record, program, project, link_dests):
-    relations = []
-    try:
-        node_id = tsv_record["submitter_id"]
-    except KeyError:
-        if node_name == "program":
-            node_id = tsv_record["dbgap_accession_number"]
-        else:
-            node_id = tsv_record["code"]
-
-    vals = tsv_record
-
-    to_del = []
-    for item in tsv_record:
-        if type(tsv_record[item]) == dict and "submitter_id" in tsv_record[item]:
-            to_del.append(item)
-            v = item
-            relations.append(
-                {
-                    "dst_id": tsv_record[item]["submitter_id"],
-                    "dst_name": link_dests[node_name][v],
-                }
-            )
+def _to_string(val):
+    if val is None or val.strip() == "":
+        return None
+    return val
 
-        # array typing being passed off as string
-        if (
-            type(tsv_record[item]) == str
-            and len(tsv_record[item]) > 0
-            and tsv_record[item][0] == "["
-            and tsv_record[item][-1] == "]"
-        ):
-            arrayStrip = tsv_record[item].strip("[']")
-            vals[item] = arrayStrip.split(",")
 
-        if ".submitter_id" in item:
-            relations.append(
-                {"dst_id": tsv_record[item], "dst_name": item.split(".")[0]}
-            )
-            to_del.append(item)
+def _to_double(val):
+    if val is None:
+        return None
+    if val.strip() in ("", "null", "Null"):
+        return None
+    return float(val)
+
 
-    for i in to_del:
-        if i in vals:
-            del vals[i]
+def _to_boolean(val):
+    return _BOOLEANS.get(val.lower())
 
-    vals["project_id"] = "{}-{}".format(program, project)
 
-    return avro_record(node_id, node_name, vals, relations)
+_BOOLEANS = {"false": False, "true": True}
+
+# field type, see get_type_from_schema -> converter of the TSV values
+CONVERTERS = {
+    "string": _to_string,
+    "enum": _to_string,
+    "double": _to_double,
+    "integer": int,
+    "long": int,
+    "boolean": _to_boolean,
+}
+
+
+def _is_array(node, field):
+    for f in node["fields"] if node else ():
+        if f["name"] == field:
+            types = f["type"] if isinstance(f["type"], list) else [f["type"]]
+            return any(isinstance(t, dict) and t["type"] == "array" for t in types)
+    return False
+
+
+def _to_array(val):
+    # array typing being passed off as string
+    if val and val[0] == "[" and val[-1] == "]":
+        return val.strip("[']").split(",")
+    return val
+
+
+def make_row_converter(schema, node_name, header, program, project):
+    """Return a function converting the TSV rows of the node into PFB records.
+
+    The converter of each column is looked up once from the TSV header, see
+    convert_types: the "<link>.submitter_id" columns become the relations of the
+    record, and the "[...]" values of array fields become lists.
+    """
+    node = next((n for n in schema if n["name"] == node_name), None)
+    # the last of the columns with the same name wins, like with csv.DictReader
+    positions = {column: i for i, column in enumerate(header)}
+    columns = []
+    relations = []
+    for column, i in positions.items():
+        if ".submitter_id" in column:
+            relations.append((i, column.split(".")[0]))
+            continue
+        convert = CONVERTERS.get(get_type_from_schema(schema, node_name, column))
+        if _is_array(node, column):
+            convert = _chain(convert, _to_array)
+        columns.append((column, i, convert))
+
+    if "submitter_id" in positions:
+        id_column = "submitter_id"
+    elif node_name == "program":
+        id_column = "dbgap_accession_number"
+    else:
+        id_column = "code"
+    project_id = "{}-{}".format(program, project)
+    width = len(header)
+
+    def convert_row(row):
+        if len(row) < width:
+            row = row + [None] * (width - len(row))
+        elif len(row) > width:
+            raise ValueError(
+                "{} cells for the {} columns of {}: {}".format(
+                    len(row), width, node_name, row
+                )
+            )
+        vals = {
+            column: row[i] if convert is None else convert(row[i])
+            for column, i, convert in columns
+        }
+        record_relations = [
+            {"dst_id": row[i], "dst_name": dst_name} for i, dst_name in relations
+        ]
+        node_id = vals[id_column]
+        vals["project_id"] = project_id
+        return avro_record(node_id, node_name, vals, record_relations)
+
+    return convert_row
+
+
+def _chain(convert, then):
+    if convert is None:
+        return then
+    return lambda val: then(convert(val))
@@ -0,0 +1,89 @@
+"""Sidecar block index of a PFB file.
+
+The index is a JSON document stored next to the PFB file with the ``.pfbidx``
+suffix. For each Avro block of the file it records the byte offset, the framed byte
+size, the number of records and the names of the nodes present in the block:
+
+    {
+        "version": 1,
+        "sync": "<hex sync marker of the PFB file>",
+        "length": <byte size of the PFB file>,
+        "blocks": [[offset, size, count, ["node", ...]], ...]
+    }
+
+The sync marker and the file length are used to detect an index that no longer
+matches its PFB file, e.g. after records were appended with `pfb add`.
+"""
+
+import json
+import os
+
+from fastavro import block_reader
+
+INDEX_SUFFIX = ".pfbidx"
+INDEX_VERSION = 1
+
+# reader schema that only decodes the node name of each record
+NAME_ONLY_SCHEMA = {
+    "type": "record",
+    "name": "Entity",
+    "fields": [{"name": "name", "type": "string"}],
+}
+
+
+def index_path(pfb_path):
+    return pfb_path + INDEX_SUFFIX
+
+
+def _file_length(fo):
+    pos = fo.tell()
+    try:
+        return fo.seek(0, os.SEEK_END)
+    finally:
+        fo.seek(pos)
+
+
+def build_index(fo, header):
+    """Scan the seekable PFB file object and return its block index."""
+    pos = fo.tell()
+    try:
+        fo.seek(0)
+        blocks = []
+        for block in block_reader(fo, NAME_ONLY_SCHEMA):
+            nodes = sorted({record["name"] for record in block})
+            blocks.append([block.offset, block.size, block.num_records, nodes])
+        length = fo.tell()
+    finally:
+        fo.seek(pos)
+    return {
+        "version": INDEX_VERSION,
+        "sync": header.sync.hex(),
+        "length": length,
+        "blocks": blocks,
+    }
+
+
+def dump_index(index, fo):
+    json.dump(index, fo, separators=(",", ":"))
+    fo.write("\n")
+
+
+def load_index(fo, header, pfb_file):
+    """Load the index from ``fo``, return None if it doesn't match the PFB file."""
+    try:
+        index = json.load(fo)
+    except ValueError:
+        return None
+    if (
+        not isinstance(index, dict)
+        or index.get("version") != INDEX_VERSION
+        or index.get("sync") != header.sync.hex()
+        or index.get("length") != _file_length(pfb_file)
+    ):
+        return None
+    return index
+
+
+def blocks_with_node(index, name):
+    """Return the ``(offset, size)`` of the blocks containing records of the node."""
+    return [(b[0], b[1]) for b in index["blocks"] if name in b[3]]
@@ -0,0 +1,54 @@
+"""Manifest of a PFB file embedded in its Avro header metadata.
+
+When asked to, :class:`pfb.writer.PFBWriter` reserves room for the manifest under
+the ``pfb.manifest`` header key, and fills it in once all the records are written:
+
+    {
+        "version": 1,
+        "length": <byte size of the PFB file>,
+        "stats": {<the counts returned by pfb.stats.collect_stats>},
+        "blocks": [[offset, size, count], ...]
+    }
+
+The block list is left out if it doesn't fit in the reserved room. The file length
+is used to detect a manifest that no longer matches its PFB file, e.g. after records
+were appended with `pfb add`.
+"""
+
+import json
+
+MANIFEST_KEY = "pfb.manifest"
+MANIFEST_VERSION = 1
+MANIFEST_SIZE = 64 * 1024
+
+# value of the header key until the manifest is filled in, an empty JSON object
+PLACEHOLDER = b"{}" + b" " * (MANIFEST_SIZE - 2)
+
+
+def dump_manifest(manifest):
+    """Return the manifest as JSON padded to MANIFEST_SIZE bytes, or None if too big."""
+    for m in (manifest, dict(manifest, blocks=None)):
+        if m["blocks"] is None:
+            del m["blocks"]
+        rv = json.dumps(m, separators=(",", ":")).encode()
+        if len(rv) <= MANIFEST_SIZE:
+            return rv.ljust(MANIFEST_SIZE)
+    return None
+
+
+def load_manifest(header, length):
+    """Return the manifest of the PFB header, or None if it doesn't match the file."""
+    raw = header.meta.get(MANIFEST_KEY)
+    if raw is None:
+        return None
+    try:
+        manifest = json.loads(raw.decode())
+    except ValueError:
+        return None
+    if (
+        not isinstance(manifest, dict)
+        or manifest.get("version") != MANIFEST_VERSION
+        or manifest.get("length") != length
+    ):
+        return None
+    return manifest
@@ -1,51 +1,531 @@
+import itertools
 import json
+import os
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from copy import deepcopy
 
 from fastavro import reader
 
-from .base import PY3, PFBBase, decode_enum, handle_schema_field_unicode, str_hook
+from .base import (
+    PY3,
+    PFBBase,
+    decode_enum,
+    enum_symbol_tables,
+    handle_schema_field_unicode,
+    str_hook,
+    translate_enums,
+)
+from .cache import cached, fingerprint
+from .columns import ColumnBuilder
+from .container import BlockStream, iter_blocks, map_file, read_header
+from .index import (
+    blocks_with_node,
+    build_index,
+    dump_index,
+    index_path,
+    load_index,
+)
 
 
-class PFBReader(PFBBase):
-    open_mode = "rb"
+def make_projection_schema(writer_schema, nodes=None, fields=None, relations=True):
+    """Build the schema of the given nodes and fields.
 
-    def __enter__(self):
-        rv = super(PFBReader, self).__enter__()
-        self._reader = reader(self._file_obj)
+    ``nodes`` is a collection of node names, all nodes are kept if it is None.
+    ``fields`` maps a node name to the names of the fields to keep for the node,
+    nodes not in the mapping keep all their fields. Unselected nodes are kept as
+    empty records, so that the union branches keep their order. The ``relations``
+    of the records are skipped if False.
+    """
+    fields = fields or {}
+    reader_fields = []
+    for f in writer_schema["fields"]:
+        if f["name"] == "relations" and not relations:
+            continue
+        if f["name"] == "object":
+            it = iter(f["type"])
+            branches = [next(it)]  # metadata
+            found = set()
+            for node in it:
+                name = node["name"]
+                if nodes is not None and name not in nodes:
+                    branches.append({"type": "record", "name": name, "fields": []})
+                    continue
+                found.add(name)
+                node = dict(node)
+                if name in fields:
+                    node_fields = {field["name"]: field for field in node["fields"]}
+                    unknown = set(fields[name]) - set(node_fields)
+                    if unknown:
+                        raise ValueError(
+                            "Unknown fields of node {}: {}".format(
+                                name, ", ".join(sorted(unknown))
+                            )
+                        )
+                    node["fields"] = [
+                        field
+                        for field in node["fields"]
+                        if field["name"] in fields[name]
+                    ]
+                branches.append(node)
+            unknown = set(nodes or ()) - found
+            if unknown:
+                raise ValueError("Unknown nodes: " + ", ".join(sorted(unknown)))
+            f = dict(f, type=branches)
+        reader_fields.append(f)
+    return dict(writer_schema, fields=reader_fields)
+
+
+CompiledSchema = namedtuple(
+    "CompiledSchema", ["writer_schema", "field_plan", "schema", "decode_plan"]
+)
+
+
+def compile_schema(schema_json, nodes=None, fields=None, relations=True):
+    """Compile the writer schema of a PFB file for reading it.
+
+    Return the writer schema, the field plan mapping the nodes projected on some of
+    their fields to the names of these fields, the decoded schema of the nodes, and
+    the decode plan mapping node names to ``{field name: {encoded symbol: decoded
+    symbol}}``. The compiled schema is cached by fingerprint, see :mod:`pfb.cache`.
+    """
+
+    def _compile():
+        writer_schema = json.loads(schema_json)
+        projection = None
+        if nodes is not None or fields or not relations:
+            projection = make_projection_schema(writer_schema, nodes, fields, relations)
         schema = []
-        self.set_encoded_schema(self._reader.writer_schema)
-        for f in self._reader.writer_schema["fields"]:
+        field_plan = {}
+        decode_plan = {}
+        for f in (projection or writer_schema)["fields"]:
             if f["name"] == "object":
                 it = iter(f["type"])
                 # skip metadata
                 next(it)
                 for node in it:
+                    if nodes is not None and node["name"] not in nodes:
+                        continue
+                    if node["name"] in (fields or ()):
+                        field_plan[node["name"]] = [
+                            field["name"] for field in node["fields"]
+                        ]
+                    tables = enum_symbol_tables(node, decode_enum)
+                    if tables:
+                        decode_plan[node["name"]] = tables
                     node = deepcopy(node)
                     schema.append(node)
                     for field in node["fields"]:
                         handle_schema_field_unicode(field, encode=False)
-        self.set_schema(json.loads(json.dumps(schema), object_pairs_hook=str_hook))
+        schema = json.loads(json.dumps(schema), object_pairs_hook=str_hook)
+        return CompiledSchema(writer_schema, field_plan, schema, decode_plan)
+
+    key = ("reader", fingerprint(schema_json, nodes, fields, relations))
+    return cached(key, _compile)
+
+
+def _select(records, nodes, decode_plan, field_plan=None, relations=True):
+    """Drop the records of unselected nodes and decode the enums of the others.
+
+    The fields of the nodes in the ``field_plan`` are restricted to the planned
+    ones, and the relations are dropped if ``relations`` is False.
+    """
+    for rv in records:
+        if nodes is not None and rv["name"] not in nodes:
+            continue
+        if field_plan and rv["name"] in field_plan:
+            obj = rv["object"]
+            rv["object"] = {name: obj[name] for name in field_plan[rv["name"]]}
+        if not relations:
+            del rv["relations"]
+        tables = decode_plan.get(rv["name"])
+        if tables:
+            translate_enums(rv["object"], tables, decode_enum)
+        yield rv
+
+
+# roughly how many bytes of blocks each parallel task decodes
+PARALLEL_TASK_SIZE = 4 * 1024 * 1024
+
+# state of a worker process decoding blocks for a parallel PFBReader
+_worker = {}
+
+
+def _init_worker(path, header_raw, select):
+    f = open(path, "rb")
+    _worker.update(file=f, mapped=map_file(f), header_raw=header_raw, select=select)
+
+
+def _decode_blocks(blocks, skip):
+    """Decode the ``(offset, size)`` blocks, skipping the first records if asked."""
+    f = _worker["file"]
+    mapped = _worker["mapped"]
+
+    def _chunks():
+        yield _worker["header_raw"]
+        for offset, size in blocks:
+            if mapped is not None:
+                yield mapped[offset : offset + size]
+            else:
+                f.seek(offset)
+                yield f.read(size)
+
+    records = reader(BlockStream(_chunks()))
+    return list(_select(itertools.islice(records, skip, None), *_worker["select"]))
+
+
+class PFBReader(PFBBase):
+    """Read records from a PFB file.
+
+    A projection can be given to read only part of the file: ``nodes`` restricts
+    the records to the given node names, ``fields`` maps node names to the fields to
+    keep, and the relations are skipped if ``relations`` is False. The schema of the
+    reader then only describes the projected nodes and fields. The records are
+    decoded with the schema of the file and projected afterwards, as resolving a
+    reader schema in fastavro costs more than decoding the dropped data, but the
+    blocks without selected nodes are skipped if the file has a block index.
+
+    With ``parallel`` greater than 1, the blocks of a local PFB file are decoded in
+    that many worker processes, and the records are yielded in file order unless
+    ``ordered`` is False. Other inputs, e.g. pipes, are always read serially. The
+    records are projected in the workers, but still sent back to this process,
+    which takes about a quarter of the time of a serial read to unpickle all the
+    records of a file, so reading it all doesn't get more than ~4x faster.
+
+    A local PFB file is memory-mapped if ``memory_map`` is True, so that blocks are
+    sliced from the page cache instead of going through buffered reads. This is off
+    by default, as it didn't measurably speed up reading.
+    """
+
+    open_mode = "rb"
+
+    def __init__(
+        self,
+        file_or_path,
+        nodes=None,
+        fields=None,
+        relations=True,
+        parallel=None,
+        ordered=True,
+        memory_map=False,
+    ):
+        super(PFBReader, self).__init__(file_or_path)
+        self._header = None
+        self._index = None
+        if fields and nodes is not None:
+            nodes = set(nodes) | set(fields)
+        self._nodes = None if nodes is None else set(nodes)
+        self._fields = fields
+        self._relations = relations
+        self._projected = nodes is not None or bool(fields) or not relations
+        self._field_plan = None
+        self._parallel = parallel
+        self._ordered = ordered
+        self._executor = None
+        self._memory_map = memory_map
+        self._mmap = None
+
+    def __enter__(self):
+        rv = super(PFBReader, self).__enter__()
+        source = self._file_obj
+        if self._memory_map and self._local_path() and self._file_obj.tell() == 0:
+            self._mmap = map_file(self._file_obj)
+            if self._mmap is not None:
+                source = self._mmap
+        if self._nodes is not None and self.load_index() is not None:
+            self._reader = reader(self._indexed_stream())
+        else:
+            self._reader = reader(source)
+        compiled = compile_schema(
+            self._reader.metadata["avro.schema"],
+            self._nodes,
+            self._fields,
+            self._relations,
+        )
+        self._field_plan = compiled.field_plan
+        self._decode_plan = compiled.decode_plan
+        self.set_encoded_schema(compiled.writer_schema)
+        self.set_schema(compiled.schema)
         self.set_metadata(next(self._reader)["object"])
+        if self._parallel and self._parallel > 1 and self._local_path():
+            self._records = self._parallel_records()
+        else:
+            self._records = self._select(self._reader)
         return rv
 
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        super(PFBReader, self).__exit__(exc_type, exc_val, exc_tb)
+
+    def _select(self, records, decode_enums=True):
+        """Project the records, see :func:`_select`."""
+        return _select(
+            records,
+            self._nodes,
+            self._decode_plan if decode_enums else {},
+            self._field_plan,
+            self._relations,
+        )
+
+    def _parallel_tasks(self):
+        """Group the blocks to decode into tasks of about PARALLEL_TASK_SIZE bytes."""
+        header = self._get_header()
+        if self._index is not None or self.load_index() is not None:
+            blocks = [
+                (offset, size)
+                for offset, size, _, names in self._index["blocks"]
+                if self._nodes is None or not self._nodes.isdisjoint(names)
+            ]
+        else:
+            with open(self._local_path(), "rb") as f:
+                f.seek(header.size)
+                blocks = [
+                    (block.offset, block.size)
+                    for block in iter_blocks(f, header, read_data=False)
+                ]
+
+        task, task_size = [], 0
+        for offset, size in blocks:
+            task.append((offset, size))
+            task_size += size
+            if task_size >= PARALLEL_TASK_SIZE:
+                yield task
+                task, task_size = [], 0
+        if task:
+            yield task
+
+    def _parallel_records(self, decode_enums=True):
+        header = self._get_header()
+        self._executor = ProcessPoolExecutor(
+            self._parallel,
+            initializer=_init_worker,
+            initargs=(
+                self._local_path(),
+                header.raw,
+                (
+                    self._nodes,
+                    self._decode_plan if decode_enums else {},
+                    self._field_plan,
+                    self._relations,
+                ),
+            ),
+        )
+        tasks = self._parallel_tasks()
+        first = next(tasks, None)
+        if first is None:
+            return
+        # the metadata record leads the first block, it was read in __enter__
+        skip = 1 if first[0][0] == header.size else 0
+
+        # keep a bounded number of tasks in flight to bound the memory use
+        pending = deque(
+            [self._executor.submit(_decode_blocks, first, skip)]
+            + [
+                self._executor.submit(_decode_blocks, task, 0)
+                for task in itertools.islice(tasks, 2 * self._parallel - 1)
+            ]
+        )
+        while pending:
+            if self._ordered:
+                done = pending.popleft()
+            else:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                done = finished.pop()
+                pending.remove(done)
+            for task in itertools.islice(tasks, 1):
+                pending.append(self._executor.submit(_decode_blocks, task, 0))
+            for rv in done.result():
+                yield rv
+
+    def _indexed_stream(self):
+        """Return the header and the blocks holding selected nodes, from the index."""
+        header = self._get_header()
+
+        def _chunks():
+            yield header.raw
+            for i, (offset, size, _, names) in enumerate(self._index["blocks"]):
+                # the first block holds the metadata record
+                if i == 0 or not self._nodes.isdisjoint(names):
+                    yield self._read_at(offset, size)
+
+        return BlockStream(_chunks())
+
     def __iter__(self):
         return self
 
     def __next__(self):
-        rv = next(self._reader)
-        obj = rv["object"]
-        to_update = {}
-        for name, value in list(obj.items()):
-            if value and self.is_encode(rv["name"], name):
-                if isinstance(value, list):
-                    thing = []
-                    for val in value:
-                        thing.append(decode_enum(val))
-                    to_update[name] = thing
-                else:
-                    to_update[name] = decode_enum(value)
-        obj.update(to_update)
-        return rv
+        return next(self._records)
+
+    def _seekable(self):
+        seekable = getattr(self._file_obj, "seekable", None)
+        return bool(seekable and seekable())
+
+    def _local_path(self):
+        """Return the path of the PFB file if it is a regular file, or None."""
+        name = getattr(self._file_obj, "name", None)
+        if isinstance(name, str) and os.path.isfile(name) and self._seekable():
+            return name
+        return None
+
+    def _index_path(self):
+        path = self._local_path()
+        return None if path is None else index_path(path)
+
+    def _get_header(self):
+        if self._header is None and self._mmap is not None:
+            self._header = read_header(BlockStream([self._mmap]))
+        elif self._header is None:
+            pos = self._file_obj.tell()
+            try:
+                self._file_obj.seek(0)
+                self._header = read_header(self._file_obj)
+            finally:
+                self._file_obj.seek(pos)
+        return self._header
+
+    def _read_at(self, offset, size):
+        if self._mmap is not None:
+            return self._mmap[offset : offset + size]
+        pos = self._file_obj.tell()
+        try:
+            self._file_obj.seek(offset)
+            return self._file_obj.read(size)
+        finally:
+            self._file_obj.seek(pos)
+
+    def iter_raw_blocks(self):
+        """Iterate the raw, still compressed blocks of a seekable PFB file."""
+        header = self._get_header()
+        pos = self._file_obj.tell()
+        try:
+            self._file_obj.seek(header.size)
+            for block in iter_blocks(self._file_obj, header):
+                yield block
+        finally:
+            self._file_obj.seek(pos)
+
+    def iter_block_records(self, blocks):
+        """Iterate the records of the ``(offset, size)`` blocks of a seekable PFB.
+
+        The blocks are given in file order, e.g. a share of the blocks to decode in
+        another process. The metadata record is skipped if the first block of the
+        file is given.
+        """
+        header = self._get_header()
+
+        def _chunks():
+            yield header.raw
+            for offset, size in blocks:
+                yield self._read_at(offset, size)
+
+        records = reader(BlockStream(_chunks()))
+        if blocks and blocks[0][0] == header.size:
+            next(records, None)
+        return self._select(records)
+
+    def make_index(self):
+        """Scan the whole PFB file and return its block index."""
+        return build_index(self._file_obj, self._get_header())
+
+    def write_index(self, path=None):
+        """Write the block index into a sidecar file and return its path.
+
+        The default path is the PFB file path with the ".pfbidx" suffix.
+        """
+        path = path or self._index_path()
+        if path is None:
+            raise ValueError("Cannot infer the index path, please specify one.")
+        index = self.make_index()
+        with open(path, "w") as f:
+            dump_index(index, f)
+        self._index = index
+        return path
+
+    def load_index(self, path=None):
+        """Load the block index from the sidecar file.
+
+        Return None if there is no index, or it doesn't match the PFB file.
+        """
+        path = path or self._index_path()
+        if path is None or not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            index = load_index(f, self._get_header(), self._file_obj)
+        if index is not None:
+            self._index = index
+        return index
+
+    def iter_node(self, name):
+        """Iterate the records of the NODE, decoding only the blocks containing it.
+
+        The block index is loaded from the sidecar file, or built by scanning the file
+        if there is none. If the file is not seekable, e.g. from a pipe, this falls
+        back to filtering the remaining records.
+        """
+        if not self._seekable():
+            for rv in self:
+                if rv["name"] == name:
+                    yield rv
+            return
+
+        for rv in self._select(self._node_records(name)):
+            if rv["name"] == name:
+                yield rv
+
+    def _node_records(self, name):
+        """Decode the blocks of a seekable PFB holding records of the NODE.
+
+        The enum values of the records are not decoded.
+        """
+        if self._index is None and self.load_index() is None:
+            self._index = self.make_index()
+        header = self._get_header()
+
+        def _chunks():
+            yield header.raw
+            for offset, size in blocks_with_node(self._index, name):
+                yield self._read_at(offset, size)
+
+        return reader(BlockStream(_chunks()))
+
+    def iter_batches(self, batch_size=10000, node=None):
+        """Iterate the records as column batches, see :mod:`pfb.columns`.
+
+        Each batch holds at most ``batch_size`` records of a single node, and maps
+        the field names, "id" and "relations" to columns. Batches are yielded as
+        they fill up, and the remaining partial batches at the end. With ``node``,
+        only the records of the NODE are read, skipping the other blocks if the PFB
+        is seekable. Otherwise, the records are decoded in worker processes if the
+        reader is parallel.
+        """
+        if node is not None and self._seekable():
+            records = self._select(self._node_records(node), decode_enums=False)
+        elif self._parallel and self._parallel > 1 and self._local_path():
+            records = self._parallel_records(decode_enums=False)
+        else:
+            records = self._select(self._reader, decode_enums=False)
+        builders = {}
+        nodes = {n["name"]: n for n in self.schema}
+        for rv in records:
+            name = rv["name"]
+            if node is not None and name != node:
+                continue
+            builder = builders.get(name)
+            if builder is None:
+                builder = builders[name] = ColumnBuilder(
+                    nodes[name], self._decode_plan.get(name, {})
+                )
+            builder.append(rv)
+            if len(builder) >= batch_size:
+                yield builder.build()
+        for builder in builders.values():
+            if len(builder):
+                yield builder.build()
 
     if not PY3:
         next = __next__
@@ -0,0 +1,106 @@
+"""Quick statistics of a PFB file.
+
+The records are decoded with a reader schema that only keeps the node name and the
+number of relations, so fastavro skips the properties of the records instead of
+building them. Files written with a manifest, see :mod:`pfb.manifest`, are not
+scanned at all.
+"""
+
+import os
+
+from fastavro import block_reader
+
+from .container import BlockStream, map_file, read_header
+from .manifest import load_manifest
+
+STATS_SCHEMA = {
+    "type": "record",
+    "name": "Entity",
+    "fields": [
+        {"name": "name", "type": "string"},
+        {
+            "name": "relations",
+            "type": {
+                "type": "array",
+                "items": {"type": "record", "name": "Relation", "fields": []},
+            },
+        },
+    ],
+}
+
+
+def _new_counts():
+    return {"records": 0, "edges": 0, "compressed_bytes": 0, "uncompressed_bytes": 0}
+
+
+def collect_stats(fo):
+    """Collect the stats of the PFB file object, read from its current position.
+
+    Return a dict with the codec, the number of blocks, the totals of records, edges
+    and compressed and uncompressed block bytes, and the same counts for each node
+    under "nodes". Block bytes are shared among the nodes of a block by their number
+    of records, so they are exact for blocks holding a single node.
+
+    The stats are taken from the manifest of the file if it has one matching the
+    file length, in which case the node bytes are shared by their encoded size.
+    """
+    mapped = None
+    length = None
+    try:
+        if fo.tell() == 0:
+            mapped = map_file(fo)
+            if mapped is not None:
+                length = len(mapped)
+            else:
+                length = fo.seek(0, os.SEEK_END)
+                fo.seek(0)
+    except (AttributeError, OSError, ValueError):
+        pass
+    try:
+        source = fo if mapped is None else BlockStream([mapped])
+        header = read_header(source)
+        manifest = None if length is None else load_manifest(header, length)
+        if manifest is not None and "stats" in manifest:
+            return manifest["stats"]
+        stats = {
+            "codec": header.meta.get("avro.codec", b"null").decode(),
+            "blocks": 0,
+        }
+        stats.update(_new_counts())
+        nodes = stats["nodes"] = {}
+        for block in block_reader(BlockStream([header.raw], tail=source), STATS_SCHEMA):
+            # the decompressed data of the block, internal to fastavro
+            uncompressed = len(block.bytes_.getbuffer())
+            stats["blocks"] += 1
+            stats["compressed_bytes"] += block.size
+            stats["uncompressed_bytes"] += uncompressed
+
+            in_block = {}
+            for record in block:
+                counts = in_block.get(record["name"])
+                if counts is None:
+                    counts = in_block[record["name"]] = [0, 0]
+                counts[0] += 1
+                counts[1] += len(record["relations"])
+            for name, (records, edges) in in_block.items():
+                if name == "Metadata":
+                    continue
+                counts = nodes.get(name)
+                if counts is None:
+                    counts = nodes[name] = _new_counts()
+                counts["records"] += records
+                counts["edges"] += edges
+                counts["compressed_bytes"] += block.size * records / block.num_records
+                counts["uncompressed_bytes"] += (
+                    uncompressed * records / block.num_records
+                )
+    finally:
+        if mapped is not None:
+            mapped.close()
+
+    for counts in nodes.values():
+        stats["records"] += counts["records"]
+        stats["edges"] += counts["edges"]
+        counts["compressed_bytes"] = int(round(counts["compressed_bytes"]))
+        counts["uncompressed_bytes"] = int(round(counts["uncompressed_bytes"]))
+    return stats
@@ -1,8 +1,39 @@
+import itertools
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
 
+from fastavro import parse_schema
+from fastavro import reader as avro_reader
 from fastavro import writer
+from fastavro.write import Writer
 
-from .base import PFBBase, encode_enum, avro_record, handle_schema_field_unicode
+from .base import (
+    PFBBase,
+    avro_record,
+    encode_enum,
+    enum_symbol_tables,
+    handle_schema_field_unicode,
+)
+from .cache import cached, fingerprint
+from .container import (
+    SYNC_SIZE,
+    BlockStream,
+    frame_block,
+    iter_blocks,
+    read_header,
+)
+from .index import NAME_ONLY_SCHEMA
+from .manifest import MANIFEST_KEY, MANIFEST_VERSION, PLACEHOLDER, dump_manifest
+
+# uncompressed byte size of the blocks, the same as the default of fastavro
+SYNC_INTERVAL = 1000 * SYNC_SIZE
+
+# Avro codecs PFBWriter can write, snappy and zstandard need optional libraries
+CODECS = ("null", "deflate", "snappy", "zstandard", "bzip2", "xz")
+CODEC_ALIASES = {"bz2": "bzip2"}
 
 
 # def add(pfbFile, parField, newField, newFieldType, newFieldDefault):
@@ -207,43 +238,563 @@ def make_avro_schema(schema):
     }
 
 
+class _TrackedFile(object):
+    """Pass the writes to the file object if any, counting the bytes written.
+
+    The written bytes are also kept while ``recording`` is True. The file is never
+    reported as seekable, so that fastavro always writes a new header into it.
+    """
+
+    def __init__(self, fo=None):
+        self._fo = fo
+        self.offset = 0
+        self.chunks = []
+        self.recording = True
+
+    def write(self, data):
+        if self.recording:
+            self.chunks.append(bytes(data))
+        if self._fo is not None:
+            self._fo.write(data)
+        self.offset += len(data)
+
+    def flush(self):
+        if self._fo is not None:
+            self._fo.flush()
+
+    def seekable(self):
+        return False
+
+
+def _codec_of(header):
+    return header.meta.get("avro.codec", b"null").decode()
+
+
+def _buffered(w):
+    """Return the byte size of the records encoded in the pending block of w."""
+    # the pure Python Writer of fastavro wraps its buffer into a BinaryEncoder
+    return getattr(w.io, "_fo", w.io).tell()
+
+
+class _BlockEncoder(object):
+    """Encode records into framed Avro blocks ending with the given sync marker.
+
+    The blocks can be written after any header with the same schema, codec and sync
+    marker, so they can be encoded apart from the file, e.g. in a worker process.
+    """
+
+    def __init__(self, schema, codec, codec_compression_level, sync_interval, sync):
+        self.schema = schema
+        self.codec = codec
+        self.codec_compression_level = codec_compression_level
+        self.sync_interval = sync_interval
+        self.sync = sync
+
+    def encode(self, records):
+        """Yield ``(data, count, uncompressed size, node counts)`` for each block.
+
+        The node counts map the node names found in the block to their number of
+        records, edges and uncompressed bytes.
+        """
+        out = _TrackedFile()
+        # blocks are dumped here instead of by fastavro, to account for them, with
+        # its internal Writer.block_count, Writer.dump() and Writer.io buffer
+        w = Writer(
+            out,
+            self.schema,
+            codec=self.codec,
+            sync_interval=2**62,
+            sync_marker=self.sync,
+            compression_level=self.codec_compression_level,
+        )
+        del out.chunks[:]  # the header
+        in_block = {}
+
+        def _dump():
+            count = w.block_count
+            uncompressed = _buffered(w)
+            w.dump()
+            rv = b"".join(out.chunks), count, uncompressed, dict(in_block)
+            del out.chunks[:]
+            in_block.clear()
+            return rv
+
+        for record in records:
+            before = _buffered(w)
+            w.write(record)
+            counts = in_block.get(record["name"])
+            if counts is None:
+                counts = in_block[record["name"]] = [0, 0, 0]
+            counts[0] += 1
+            counts[1] += len(record.get("relations") or ())
+            counts[2] += _buffered(w) - before
+            if _buffered(w) >= self.sync_interval:
+                yield _dump()
+        if w.block_count:
+            yield _dump()
+
+
+def _with_branches(records):
+    """Tag the objects of records decoded with fastavro with their union branch."""
+    for record in records:
+        record["object"] = (record["name"], record["object"])
+        yield record
+
+
+def _layout(t):
+    """Return what of the Avro type decides the encoding of its values.
+
+    Names and enum symbols are left out, as values of enums are encoded by index.
+    """
+    if isinstance(t, list):
+        return [_layout(branch) for branch in t]
+    if not isinstance(t, dict):
+        return t
+    if t["type"] == "enum":
+        return ("enum", len(t["symbols"]))
+    if t["type"] == "record":
+        return ("record", [(f["name"], _layout(f["type"])) for f in t["fields"]])
+    if t["type"] == "array":
+        return ("array", _layout(t["items"]))
+    if t["type"] == "map":
+        return ("map", _layout(t["values"]))
+    return _layout(t["type"])
+
+
+def _only_enums(t):
+    """Tell whether all the non-null values of the type are enums or enum arrays."""
+    if isinstance(t, list):
+        return all(_only_enums(branch) for branch in t if branch != "null")
+    if isinstance(t, dict) and t["type"] == "array":
+        return isinstance(t["items"], dict) and t["items"]["type"] == "enum"
+    return isinstance(t, dict) and t["type"] == "enum"
+
+
+# how many records each task encodes, a block ends at the end of each task
+PARALLEL_TASK_RECORDS = 10000
+
+# block encoder of a worker process of a parallel PFBWriter
+_worker = {}
+
+
+def _init_worker(encoder):
+    _worker["encoder"] = encoder
+
+
+def _encode_blocks(records):
+    return list(_worker["encoder"].encode(records))
+
+
+def _tasks(records):
+    """Group the records into lists of PARALLEL_TASK_RECORDS records."""
+    records = iter(records)
+    return iter(lambda: list(itertools.islice(records, PARALLEL_TASK_RECORDS)), [])
+
+
 class PFBWriter(PFBBase):
+    """Write records into a PFB file.
+
+    The blocks are compressed with the Avro ``codec``, null by default, at
+    ``codec_compression_level`` if given, and hold about ``sync_interval`` bytes of
+    uncompressed records. When records are appended to an existing PFB file, the
+    codec of the file is kept.
+
+    With ``parallel`` greater than 1, the blocks of a new PFB file are encoded and
+    compressed in that many worker processes, and written in the order of the
+    records. The blocks end at the same records whatever the number of processes.
+
+    With ``manifest``, the per-node record, edge and byte counts and the offsets of
+    the blocks are embedded in the Avro header once all records are written, see
+    :mod:`pfb.manifest`. This needs a seekable output file.
+    """
+
     open_mode = "wb"
 
-    def __init__(self, file_or_path):
+    def __init__(
+        self,
+        file_or_path,
+        manifest=False,
+        codec=None,
+        codec_compression_level=None,
+        sync_interval=SYNC_INTERVAL,
+        parallel=None,
+    ):
         super(PFBWriter, self).__init__(file_or_path)
-        self._hooks = []
+        if codec is not None:
+            codec = CODEC_ALIASES.get(codec, codec)
+            if codec not in CODECS:
+                raise ValueError("Unknown codec: {}".format(codec))
+        # None keeps the codec of the blocks copied from other PFB files, or null
+        self._codec = codec
+        self._codec_compression_level = codec_compression_level
+        self._sync_interval = sync_interval
+        # old node name -> new node name
+        self._node_renames = {}
+        # field name -> {old symbol: new symbol}
+        self._enum_renames = {}
+        self._manifest = manifest
+        self._parallel = parallel
 
     def copy_schema(self, reader):
         self.set_schema(deepcopy(reader.schema))
         self.set_metadata(reader.metadata)
 
+    def _compile_node(self, name):
+        """Return the output name and the enum translations of records of the node.
+
+        The translations are ``(field, table, encode)`` tuples, where ``table`` maps a
+        value to its renamed and encoded symbol, and ``encode`` tells whether values
+        missing from the table are encoded, i.e. whether the field is an enum.
+        """
+        out_name = self._node_renames.get(name, name)
+        tables = {}
+        for node in self.schema:
+            if node["name"] == out_name:
+                tables = enum_symbol_tables(node, encode_enum)
+                fields = {field["name"] for field in node["fields"]}
+                break
+        else:
+            fields = set()
+        plan = []
+        for field in fields:
+            table = tables.get(field)
+            renames = self._enum_renames.get(field)
+            if renames:
+                if table is None:
+                    table = dict(renames)
+                else:
+                    for old, new in renames.items():
+                        table[old] = table[new] if new in table else encode_enum(new)
+            if table is not None:
+                plan.append((field, table, field in tables))
+        return out_name, plan
+
+    def _compile(self):
+        """Return the Avro schema parsed by fastavro and the plans of the nodes.
+
+        The plans map node names to their ``_compile_node`` result, and are filled
+        on first use. Both are cached by the fingerprint of the schema and renames,
+        see :mod:`pfb.cache`.
+        """
+        key = (
+            "writer",
+            fingerprint(self.schema, self._node_renames, self._enum_renames),
+        )
+        return cached(key, lambda: (parse_schema(make_avro_schema(self.schema)), {}))
+
     def write(self, iterable=None, metadata=True):
+        schema, plans = self._compile()
+
         def _iter():
             if metadata:
                 yield avro_record(None, "Metadata", self._metadata, [])
             if iterable is not None:
                 for record in iterable:
-                    obj = record["object"]
                     name = record["name"]
-                    record["object"] = (name, obj)
-                    for hook in self._hooks:
-                        record = hook(record)
-
-                    to_update = {}
-                    for field, value in list(obj.items()):
-                        if value is not None and self.is_encode(name, field):
-                            if isinstance(value, list):
-                                # this is needed to not encode list brackets
-                                obj[field] = []
-                                for element in value:
-                                    obj[field].append(encode_enum(element))
-                            else:
-                                obj[field] = encode_enum(value)
-                    obj.update(to_update)
+                    plan = plans.get(name)
+                    if plan is None:
+                        plan = plans[name] = self._compile_node(name)
+                    out_name, translations = plan
+                    obj = record["object"]
+                    record["name"] = out_name
+                    record["object"] = (out_name, obj)
+                    for field, table, encode in translations:
+                        value = obj.get(field)
+                        if not value:
+                            continue
+                        if isinstance(value, list):
+                            obj[field] = [
+                                (
+                                    table[element]
+                                    if element in table
+                                    else (encode_enum(element) if encode else element)
+                                )
+                                for element in value
+                            ]
+                        elif value in table:
+                            obj[field] = table[value]
+                        elif encode:
+                            obj[field] = encode_enum(value)
                     yield record
 
-        writer(self._file_obj, make_avro_schema(self.schema), _iter())
+        if metadata:
+            self._write_blocks(schema, _iter())
+        else:
+            writer(
+                self._file_obj,
+                schema,
+                _iter(),
+                codec=self._codec or "null",
+                sync_interval=self._sync_interval,
+                codec_compression_level=self._codec_compression_level,
+            )
+
+    def _write_blocks(self, schema, records):
+        """Write the header, then the records encoded by a _BlockEncoder.
+
+        Blocks are encoded in worker processes if parallel, and the manifest is
+        filled in if asked.
+        """
+        fo = self._file_obj
+        if self._manifest:
+            seekable = getattr(fo, "seekable", None)
+            if not (seekable and seekable()):
+                raise ValueError("A manifest can only be written into a seekable file.")
+            start = fo.tell()
+        out = _TrackedFile(fo)
+        sync = os.urandom(SYNC_SIZE)
+        Writer(
+            out,
+            schema,
+            codec=self._codec or "null",
+            metadata={MANIFEST_KEY: PLACEHOLDER.decode()} if self._manifest else None,
+            sync_marker=sync,
+        )
+        out.recording = False
+        encoder = _BlockEncoder(
+            schema,
+            self._codec or "null",
+            self._codec_compression_level,
+            self._sync_interval,
+            sync,
+        )
+
+        stats = {
+            "codec": self._codec or "null",
+            "blocks": 0,
+            "records": 0,
+            "edges": 0,
+            "compressed_bytes": 0,
+            "uncompressed_bytes": 0,
+        }
+        nodes = stats["nodes"] = {}
+        blocks = []
+        # blocks end at the end of each task, whether encoded in parallel or not,
+        # so that the output doesn't depend on the number of processes
+        tasks = _tasks(records)
+        if self._parallel and self._parallel > 1:
+            encoded = self._parallel_blocks(encoder, tasks)
+        else:
+            encoded = itertools.chain.from_iterable(map(encoder.encode, tasks))
+        for data, count, uncompressed, in_block in encoded:
+            offset = out.offset
+            out.write(data)
+            if not self._manifest:
+                continue
+            blocks.append([start + offset, len(data), count])
+            stats["blocks"] += 1
+            stats["compressed_bytes"] += len(data)
+            stats["uncompressed_bytes"] += uncompressed
+            for name, (n_records, edges, nbytes) in in_block.items():
+                if name == "Metadata":
+                    continue
+                counts = nodes.get(name)
+                if counts is None:
+                    counts = nodes[name] = {
+                        "records": 0,
+                        "edges": 0,
+                        "compressed_bytes": 0,
+                        "uncompressed_bytes": 0,
+                    }
+                counts["records"] += n_records
+                counts["edges"] += edges
+                counts["uncompressed_bytes"] += nbytes
+                counts["compressed_bytes"] += len(data) * nbytes / uncompressed
+        out.flush()
+        if not self._manifest:
+            return
+
+        for counts in nodes.values():
+            stats["records"] += counts["records"]
+            stats["edges"] += counts["edges"]
+            counts["compressed_bytes"] = int(round(counts["compressed_bytes"]))
+        data = dump_manifest(
+            {
+                "version": MANIFEST_VERSION,
+                "length": start + out.offset,
+                "stats": stats,
+                "blocks": blocks,
+            }
+        )
+        if data is not None:
+            end = fo.tell()
+            fo.seek(start + b"".join(out.chunks).find(PLACEHOLDER))
+            fo.write(data)
+            fo.seek(end)
+
+    def _parallel_blocks(self, encoder, tasks):
+        """Encode tasks of records in worker processes, yield the blocks in order."""
+        with ProcessPoolExecutor(
+            self._parallel, initializer=_init_worker, initargs=(encoder,)
+        ) as executor:
+            # keep a bounded number of tasks in flight to bound the memory use
+            pending = deque(
+                executor.submit(_encode_blocks, task)
+                for task in itertools.islice(tasks, 2 * self._parallel)
+            )
+            while pending:
+                done = pending.popleft()
+                for task in itertools.islice(tasks, 1):
+                    pending.append(executor.submit(_encode_blocks, task))
+                for rv in done.result():
+                    yield rv
+
+    def _can_copy_blocks(self, reader, header):
+        """Tell whether the raw blocks of the reader can be copied after the renames.
+
+        Only the schema of the reader may have been changed, by renaming nodes and
+        enum symbols, and the blocks must not be recompressed.
+        """
+        if (
+            reader._projected
+            or not reader._seekable()
+            or self._manifest
+            or self._codec_compression_level is not None
+            or self._codec != _codec_of(header)
+        ):
+            return False
+        # the whole schema, as the envelope of the records, e.g. the branches of the
+        # object union or the metadata record, can differ from the one written
+        if _layout(reader._encoded_schema) != _layout(make_avro_schema(self.schema)):
+            return False
+        # the renames of symbols also apply to string fields of the same name
+        for node in self.schema:
+            for field in node["fields"]:
+                if field["name"] in self._enum_renames and not _only_enums(
+                    field["type"]
+                ):
+                    return False
+        return True
+
+    def copy_records(self, reader):
+        """Write the records of the PFB reader with the renames applied.
+
+        Renaming nodes and enum symbols only changes the schema, as union branches
+        and enum symbols are encoded by index. If the reader is seekable, the raw
+        blocks are then copied as they are after a new header, except blocks holding
+        records of a renamed node, whose name is also stored in each record.
+        Otherwise, the records are decoded and written again.
+        """
+        if not reader._seekable():
+            # the header can't be read again from a stream
+            if self._codec is None:
+                self._codec = reader._reader.metadata.get("avro.codec", "null")
+            self.write(reader)
+            return
+        header = reader._get_header()
+        if self._codec is None:
+            self._codec = _codec_of(header)
+        if not self._can_copy_blocks(reader, header):
+            self.write(reader)
+            return
+
+        schema, _ = self._compile()
+        out = _TrackedFile(self._file_obj)
+        Writer(out, schema, codec=self._codec, sync_marker=header.sync)
+        encoder = _BlockEncoder(
+            schema, self._codec, None, self._sync_interval, header.sync
+        )
+        enum_renames = {
+            field: {encode_enum(old): encode_enum(new) for old, new in renames.items()}
+            for field, renames in self._enum_renames.items()
+        }
+
+        def _renamed(records):
+            for record in records:
+                record["name"] = self._node_renames.get(record["name"], record["name"])
+                obj = record["object"]
+                for field, renames in enum_renames.items():
+                    value = obj.get(field)
+                    if isinstance(value, list):
+                        obj[field] = [renames.get(v, v) for v in value]
+                    elif value in renames:
+                        obj[field] = renames[value]
+                yield record
+
+        for block in reader.iter_raw_blocks():
+            data = frame_block(block.count, block.data, header.sync)
+            if self._node_renames:
+                names = avro_reader(BlockStream([header.raw, data]), NAME_ONLY_SCHEMA)
+                if any(r["name"] in self._node_renames for r in names):
+                    records = avro_reader(BlockStream([header.raw, data]))
+                    for data, _, _, _ in encoder.encode(
+                        _with_branches(_renamed(records))
+                    ):
+                        out.write(data)
+                    continue
+            out.write(data)
+        out.flush()
+
+    def merge(self, readers):
+        """Write the records of the PFB readers one after another.
+
+        If the readers are seekable and have the same encoded schema and codec, their
+        blocks are copied without decoding the records, framed with the sync marker
+        of the output. Only the metadata record leading the first block of the other
+        readers is dropped, by encoding that block again.
+
+        Otherwise the readers can only differ by their nodes: the output has all the
+        nodes, and the records are decoded and written again. Either way, the output
+        has the metadata of the first reader, with the other nodes added.
+        """
+        # the header can't be read again from a stream
+        headers = [
+            reader._get_header() if reader._seekable() else None for reader in readers
+        ]
+        if self._codec is None:
+            if headers[0] is not None:
+                self._codec = _codec_of(headers[0])
+            else:
+                self._codec = readers[0]._reader.metadata.get("avro.codec", "null")
+        if not all(
+            header is not None
+            and not reader._projected
+            and reader._encoded_schema == readers[0]._encoded_schema
+            and _codec_of(header) == self._codec
+            for reader, header in zip(readers, headers)
+        ) or (self._manifest or self._codec_compression_level is not None):
+            self._merge_schemas(readers)
+            self.write(itertools.chain.from_iterable(readers))
+            return
+
+        self.copy_schema(readers[0])
+        schema = readers[0]._encoded_schema
+        out = _TrackedFile(self._file_obj)
+        sync = os.urandom(SYNC_SIZE)
+        Writer(out, schema, codec=self._codec, sync_marker=sync)
+        encoder = _BlockEncoder(schema, self._codec, None, self._sync_interval, sync)
+        for i, (reader, header) in enumerate(zip(readers, headers)):
+            for j, block in enumerate(reader.iter_raw_blocks()):
+                if i > 0 and j == 0:
+                    data = frame_block(block.count, block.data, header.sync)
+                    records = avro_reader(BlockStream([header.raw, data]))
+                    next(records)  # metadata
+                    for data, _, _, _ in encoder.encode(_with_branches(records)):
+                        out.write(data)
+                else:
+                    out.write(frame_block(block.count, block.data, sync))
+        out.flush()
+
+    def _merge_schemas(self, readers):
+        nodes = {}
+        schema = []
+        metadata = deepcopy(readers[0].metadata)
+        described = {node["name"] for node in metadata["nodes"]}
+        for reader in readers:
+            for node in reader.schema:
+                if node["name"] not in nodes:
+                    nodes[node["name"]] = node
+                    schema.append(deepcopy(node))
+                elif nodes[node["name"]] != node:
+                    raise ValueError(
+                        "Cannot merge different schemas of node " + node["name"]
+                    )
+            for node in reader.metadata["nodes"]:
+                if node["name"] not in described:
+                    described.add(node["name"])
+                    metadata["nodes"].append(deepcopy(node))
+        self.set_schema(schema)
+        self.set_metadata(metadata)
 
     def rename_node(self, name_from, name_to):
         if type(name_from) == bytes:
@@ -259,13 +810,10 @@ class PFBWriter(PFBBase):
                         if isinstance(type_, dict) and type_.get("type") == "enum":
                             type_["name"] = type_["name"].replace(name_from, name_to)
 
-        def _rename_node(record):
-            if record["name"] == name_from:
-                record["name"] = name_to
-                record["object"] = (name_to, record["object"][1])
-            return record
-
-        self._hooks.append(_rename_node)
+        for old, new in list(self._node_renames.items()):
+            if new == name_from:
+                self._node_renames[old] = name_to
+        self._node_renames.setdefault(name_from, name_to)
 
     def rename_enum(self, field_name, val_from, val_to):
         if type(val_from) == bytes:
@@ -288,10 +836,113 @@ class PFBWriter(PFBBase):
                     if node["name"] in renamed and field["default"] == val_from:
                         field["default"] = val_to
 
-        def _rename_enum(record):
-            obj = record["object"][1]
-            if obj.get(field_name) == val_from:
-                obj[field_name] = val_to
-            return record
+        renames = self._enum_renames.setdefault(field_name, {})
+        for old, new in list(renames.items()):
+            if new == val_from:
+                renames[old] = val_to
+        renames.setdefault(val_from, val_to)
+
+
+def split(fo, open_shard, by_node=False, max_records=None, max_bytes=None):
+    """Split the PFB file object into shards, return the keys of the shards.
+
+    ``open_shard(key)`` returns the binary file object to write a shard into, where
+    ``key`` is the node name when splitting ``by_node``, or the shard number. It is
+    closed once the shard is written. Each shard is a PFB file with the schema and
+    the metadata of the input, and holds the records of one node, or at most
+    ``max_records`` records and ``max_bytes`` bytes, unless a single block is larger.
+
+    Blocks are copied whole, only the first block and blocks that cannot be grouped,
+    i.e. holding several nodes or more than ``max_records`` records, are decoded.
+    """
+    header = read_header(fo)
+    schema = json.loads(header.meta["avro.schema"].decode())
+    codec = _codec_of(header)
+    encoder = _BlockEncoder(schema, codec, None, SYNC_INTERVAL, header.sync)
+
+    def _framed(block):
+        return frame_block(block.count, block.data, header.sync)
+
+    def _decode(block, reader_schema=None):
+        return list(
+            avro_reader(BlockStream([header.raw, _framed(block)]), reader_schema)
+        )
+
+    blocks = iter_blocks(fo, header)
+    first = next(blocks, None)
+    if first is None:
+        raise ValueError("The PFB file has no metadata record")
+    # the metadata record leads the first block
+    metadata, *records = _decode(first)
+    out = _TrackedFile()
+    Writer(out, schema, codec=codec, sync_marker=header.sync)
+    for data, _, _, _ in encoder.encode(_with_branches([metadata])):
+        out.write(data)
+    prefix = b"".join(out.chunks)
+
+    # key -> [file object, number of records, byte size]
+    shards = {}
+    keys = []
+
+    def _place(key, data, count):
+        shard = shards.get(key)
+        if shard is None:
+            if keys and not by_node:
+                # shards are written one after another
+                shards[keys[-1]][0].close()
+            shard = shards[key] = [open_shard(key), 0, len(prefix)]
+            shard[0].write(prefix)
+            keys.append(key)
+        shard[0].write(data)
+        shard[1] += count
+        shard[2] += len(data)
+
+    def _place_next(data, count):
+        """Place the block in the last shard, or a new one if it doesn't fit."""
+        key = keys[-1] if keys else 0
+        shard = shards.get(key)
+        if shard is not None and shard[1] > 0:
+            if (max_records and shard[1] + count > max_records) or (
+                max_bytes and shard[2] + len(data) > max_bytes
+            ):
+                key += 1
+        _place(key, data, count)
+
+    def _place_records(records):
+        while records:
+            piece = records
+            if max_records:
+                room = max_records - shards[keys[-1]][1] if keys else max_records
+                piece = records[: room if room > 0 else max_records]
+            records = records[len(piece) :]
+            for data, count, _, _ in encoder.encode(_with_branches(piece)):
+                _place_next(data, count)
+
+    def _place_by_node(records):
+        by_name = {}
+        for record in records:
+            by_name.setdefault(record["name"], []).append(record)
+        for name, node_records in by_name.items():
+            for data, count, _, _ in encoder.encode(_with_branches(node_records)):
+                _place(name, data, count)
 
-        self._hooks.append(_rename_enum)
+    try:
+        if by_node:
+            _place_by_node(records)
+            for block in blocks:
+                names = {r["name"] for r in _decode(block, NAME_ONLY_SCHEMA)}
+                if len(names) == 1:
+                    _place(names.pop(), _framed(block), block.count)
+                else:
+                    _place_by_node(_decode(block))
+        else:
+            _place_records(records)
+            for block in blocks:
+                if max_records and block.count > max_records:
+                    _place_records(_decode(block))
+                else:
+                    _place_next(_framed(block), block.count)
+    finally:
+        for shard in shards.values():
+            shard[0].close()
+    return keys
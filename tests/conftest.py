@@ -1,3 +1,4 @@
+import io
 import os
 
 import pytest
@@ -33,3 +34,41 @@ def invoke(runner):
 def test_avro(path_join):
     with open(path_join("pfb-data", "test.avro"), "rb") as f:
         return f.read()
+
+
+class _Pipe(io.RawIOBase):
+    """A binary stream which can't seek, like stdin reading from a pipe."""
+
+    def __init__(self, data):
+        self._data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self._data.readinto(b)
+
+
+@pytest.fixture
+def pipe():
+    def _pipe(data):
+        return io.BufferedReader(_Pipe(data))
+
+    return _pipe
+
+
+@pytest.fixture
+def multi_block_pfb(path_join, tmp_path):
+    """A PFB file of many blocks, with the records grouped by node."""
+    from copy import deepcopy
+
+    from pfb.reader import PFBReader
+    from pfb.writer import PFBWriter
+
+    path = str(tmp_path / "multi_block.avro")
+    with PFBReader(path_join("pfb-data", "test.avro")) as reader:
+        records = sorted(reader, key=lambda r: r["name"])
+        with PFBWriter(path) as writer:
+            writer.copy_schema(reader)
+            writer.write(deepcopy(r) for r in records for _ in range(50))
+    return path
@@ -4,6 +4,7 @@ import json
 import os
 import shutil
 
+import pytest
 from fastavro import reader
 
 from pfb.base import decode_enum, encode_enum, str_hook
@@ -104,6 +105,53 @@ def test_from_tsv(runner, invoke, path_join):
                         assert obj["file_name"] == "virtuosi_conticent"
 
 
+def test_tsv_row_converter():
+    from pfb.importers.tsv import make_row_converter
+
+    schema = [
+        {
+            "name": "sample",
+            "fields": [
+                {"name": "submitter_id", "type": ["null", "string"]},
+                {"name": "weight", "type": ["null", "double"]},
+                {"name": "days", "type": ["null", "long"]},
+                {"name": "frozen", "type": ["null", "boolean"]},
+                {
+                    "name": "tags",
+                    "type": ["null", {"type": "array", "items": "string"}],
+                },
+            ],
+        }
+    ]
+    header = [
+        "type",
+        "submitter_id",
+        "weight",
+        "days",
+        "frozen",
+        "tags",
+        "participants.submitter_id",
+    ]
+    convert = make_row_converter(schema, "sample", header, "DEV", "test")
+    record = convert(["sample", "s1", " null ", "12", "True", "[a,b]", "p1"])
+    assert record["id"] == "s1"
+    assert record["object"] == {
+        "type": "sample",
+        "submitter_id": "s1",
+        "weight": None,
+        "days": 12,
+        "frozen": True,
+        "tags": ["a", "b"],
+        "project_id": "DEV-test",
+    }
+    assert record["relations"] == [{"dst_id": "p1", "dst_name": "participants"}]
+
+    record = convert(["sample", "s2", "1.5", "0", "", "", ""])
+    assert record["object"]["weight"] == 1.5
+    assert record["object"]["frozen"] is None
+    assert record["object"]["tags"] is None
+
+
 def test_to_gremlin(runner, invoke, path_join, test_avro):
     with runner.isolated_filesystem():
         result = invoke("to", "gremlin", "./output", input=test_avro)
@@ -130,6 +178,104 @@ def test_to_gremlin(runner, invoke, path_join, test_avro):
             }
 
 
+def test_to_gremlin_stable_ids(runner, invoke, test_avro):
+    def _read(path):
+        with gzip.open(path, "rt") as f:
+            return list(csv.reader(f))
+
+    with runner.isolated_filesystem():
+        for output in ("first", "second"):
+            result = invoke("to", "gremlin", "--stable-ids", output, input=test_avro)
+            assert result.exit_code == 0, result.output
+        assert sorted(os.listdir("first")) == sorted(os.listdir("second"))
+        for name in os.listdir("first"):
+            assert _read(os.path.join("first", name)) == _read(
+                os.path.join("second", name)
+            )
+
+        vertex_ids = set()
+        for name in os.listdir("first"):
+            if name != "gremlin_edges.csv.gz":
+                vertex_ids.update(r[1] for r in _read(os.path.join("first", name))[1:])
+        edges = _read(os.path.join("first", "gremlin_edges.csv.gz"))[1:]
+        assert edges
+        for _, src, dst, _ in edges:
+            assert src in vertex_ids
+            assert dst in vertex_ids
+
+
+def test_to_gremlin_max_size(multi_block_pfb, tmp_path):
+    from pfb.exporters.gremlin import _CsvOutput, _to_gremlin, write_manifest
+    from pfb.reader import PFBReader
+
+    def _read(path):
+        with gzip.open(str(path), "rt") as f:
+            return list(csv.reader(f))
+
+    for output, max_size in (("single", None), ("rolled", 50000)):
+        with PFBReader(multi_block_pfb) as reader:
+            with _CsvOutput(str(tmp_path / output), True, max_size, 2) as out:
+                _to_gremlin(reader, out, stable_ids=True)
+            write_manifest(str(tmp_path / output), out.files)
+
+    expected = _read(tmp_path / "single" / "gremlin_edges.csv.gz")
+    names = sorted(os.listdir(str(tmp_path / "rolled")))
+    edge_files = [name for name in names if name.startswith("gremlin_edges.")]
+    assert edge_files[:2] == ["gremlin_edges.0000.csv.gz", "gremlin_edges.0001.csv.gz"]
+    rows = []
+    for name in edge_files:
+        chunk = _read(tmp_path / "rolled" / name)
+        assert chunk[0] == expected[0]
+        assert sum(len(",".join(row)) + 2 for row in chunk) < 50000 + 1000
+        rows.extend(chunk[1:])
+    assert rows == expected[1:]
+
+    with open(str(tmp_path / "rolled" / "manifest.json")) as f:
+        manifest = json.load(f)
+    files = manifest["files"]
+    assert sorted(entry["path"] for entry in files) == [
+        name for name in names if name != "manifest.json"
+    ]
+    assert [entry["type"] for entry in files].index("edge") == len(files) - len(
+        edge_files
+    )
+    assert sum(e["records"] for e in files if e["type"] == "edge") == len(rows)
+
+
+def test_to_gremlin_parallel(runner, invoke, multi_block_pfb):
+    def _rows(output):
+        rv = {}
+        for name in os.listdir(output):
+            if name.endswith(".csv.gz"):
+                with gzip.open(os.path.join(output, name), "rt") as f:
+                    rows = list(csv.reader(f))
+                rv.setdefault(name.split(".")[0], []).extend(rows[1:])
+        return {name: sorted(rows) for name, rows in rv.items()}
+
+    with runner.isolated_filesystem():
+        result = invoke(
+            "to", "-i", multi_block_pfb, "gremlin", "--stable-ids", "serial"
+        )
+        assert result.exit_code == 0, result.output
+        result = invoke(
+            "to",
+            "-i",
+            multi_block_pfb,
+            "-j",
+            "2",
+            "gremlin",
+            "--stable-ids",
+            "--manifest",
+            "parallel",
+        )
+        assert result.exit_code == 0, result.output
+        assert "gremlin_edges.part01.csv.gz" in os.listdir("parallel")
+        assert _rows("parallel") == _rows("serial")
+        with open(os.path.join("parallel", "manifest.json")) as f:
+            manifest = json.load(f)
+        assert len(manifest["files"]) == len(os.listdir("parallel")) - 1
+
+
 def test_to_tsv(runner, invoke, test_avro):
     with runner.isolated_filesystem():
         result = invoke("to", "tsv", "./tsvs", input=test_avro)
@@ -153,9 +299,143 @@ def test_to_tsv(runner, invoke, test_avro):
                 "created_datetime": "",
                 "race": "Native Hawaiian or Other Pacific Islander",
                 "state": "validated",
-                "participants.submitter_id": "null",
+                "participants.submitter_id": "participant_metalinguistics_monofilm",
                 "id": "demographic_duteousness_unassailing",
             }
+        # every row has the columns of the header
+        for name in os.listdir("tsvs"):
+            with open(os.path.join("tsvs", name), "rt") as f:
+                assert len({len(row) for row in csv.reader(f, delimiter="\t")}) == 1
+
+
+def test_to_tsv_no_submitter_id(runner, invoke, path_join, tmp_path):
+    from pfb.reader import PFBReader
+    from pfb.writer import PFBWriter
+
+    # program records have no submitter_id field
+    path = str(tmp_path / "program.avro")
+    with PFBReader(path_join("pfb-data", "test.avro")) as reader:
+        with PFBWriter(path) as writer:
+            writer.copy_schema(reader)
+            program = {
+                "id": "program_1",
+                "name": "program",
+                "object": {"name": "DEV", "dbgap_accession_number": None},
+                "relations": [],
+            }
+            writer.write([program] + list(reader))
+    with runner.isolated_filesystem():
+        result = invoke("to", "-i", path, "tsv", "./tsvs")
+        assert result.exit_code == 0, result.output
+        with open(os.path.join("tsvs", "program.tsv"), "rt") as f:
+            rows = list(csv.DictReader(f, delimiter="\t"))
+        assert [row["id"] for row in rows] == ["program_1"]
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_to_tsv_writers(runner, invoke, test_avro, monkeypatch, jobs):
+    import pfb.exporters.tsv
+
+    monkeypatch.setattr(pfb.exporters.tsv, "BATCH_ROWS", 2)
+    with runner.isolated_filesystem():
+        result = invoke("to", "tsv", "./serial", input=test_avro)
+        assert result.exit_code == 0, result.output
+        result = invoke(
+            "to", "-j", jobs, "tsv", "-w", "3", "./parallel", input=test_avro
+        )
+        assert result.exit_code == 0, result.output
+        assert sorted(os.listdir("parallel")) == sorted(os.listdir("serial"))
+        for name in os.listdir("serial"):
+            with open(os.path.join("serial", name)) as f:
+                expected = f.read()
+            with open(os.path.join("parallel", name)) as f:
+                assert f.read() == expected
+
+
+def test_to_tsv_chunks(runner, invoke, multi_block_pfb):
+    with runner.isolated_filesystem():
+        result = invoke("to", "-i", multi_block_pfb, "tsv", "./tsvs")
+        assert result.exit_code == 0, result.output
+        result = invoke(
+            "to",
+            "-i",
+            multi_block_pfb,
+            "tsv",
+            "-w",
+            "2",
+            "--compress",
+            "gzip",
+            "--max-rows-per-file",
+            "20",
+            "./chunks",
+        )
+        assert result.exit_code == 0, result.output
+        assert sorted(os.listdir("chunks"))[:3] == [
+            "aligned_reads.000.tsv.gz",
+            "aligned_reads.001.tsv.gz",
+            "aligned_reads.002.tsv.gz",
+        ]
+        with open(os.path.join("tsvs", "demographic.tsv"), "rt") as f:
+            expected = list(csv.reader(f, delimiter="\t"))
+        rows = []
+        for i in range(3):
+            path = os.path.join("chunks", "demographic.{:03d}.tsv.gz".format(i))
+            with gzip.open(path, "rt") as f:
+                chunk = list(csv.reader(f, delimiter="\t"))
+            assert chunk[0] == expected[0]
+            rows.extend(chunk[1:])
+        assert len(rows) == 50
+        assert rows == expected[1:]
+
+
+def test_to_tsv_zstd(runner, invoke, test_avro):
+    zstandard = pytest.importorskip("zstandard")
+    with runner.isolated_filesystem():
+        result = invoke("to", "tsv", "./tsvs", input=test_avro)
+        assert result.exit_code == 0, result.output
+        result = invoke("to", "tsv", "--compress", "zstd", "./zst", input=test_avro)
+        assert result.exit_code == 0, result.output
+        for name in os.listdir("tsvs"):
+            with open(os.path.join("tsvs", name), "rt") as f:
+                expected = f.read()
+            with zstandard.open(os.path.join("zst", name + ".zst"), "rt") as f:
+                assert f.read() == expected
+
+
+def test_to_parquet(runner, invoke, test_avro):
+    pq = pytest.importorskip("pyarrow.parquet")
+    with runner.isolated_filesystem():
+        result = invoke(
+            "to", "parquet", "--row-group-size", "2", "./parquet", input=test_avro
+        )
+        assert result.exit_code == 0, result.output
+        table = pq.read_table(os.path.join("parquet", "demographic", "part-0.parquet"))
+        assert table.schema.field("gender").type.value_type == "string"
+        assert table.schema.field("age_at_last_follow_up_days").type == "int64"
+        rows = table.to_pylist()
+        assert len(rows) == 1
+        assert rows[0]["id"] == "demographic_duteousness_unassailing"
+        assert rows[0]["gender"] == "female"
+        assert rows[0]["age_at_last_follow_up_days"] == 18074
+        assert rows[0]["participants.id"] == "participant_metalinguistics_monofilm"
+        assert rows[0]["updated_datetime"] is None
+
+
+def test_to_parquet_jobs(runner, invoke, multi_block_pfb, monkeypatch):
+    pq = pytest.importorskip("pyarrow.parquet")
+    import pfb.reader
+
+    monkeypatch.setattr(pfb.reader, "PARALLEL_TASK_SIZE", 64 * 1024)
+    with runner.isolated_filesystem():
+        result = invoke("to", "-i", multi_block_pfb, "parquet", "./serial")
+        assert result.exit_code == 0, result.output
+        result = invoke("to", "-i", multi_block_pfb, "-j", "2", "parquet", "./parallel")
+        assert result.exit_code == 0, result.output
+        assert sorted(os.listdir("parallel")) == sorted(os.listdir("serial"))
+        for name in os.listdir("serial"):
+            path = os.path.join(name, "part-0.parquet")
+            expected = pq.read_table(os.path.join("serial", path))
+            assert pq.read_table(os.path.join("parallel", path)).equals(expected)
 
 
 def test_make(invoke, path_join):
@@ -307,6 +587,24 @@ def test_rename_node(runner, invoke, test_avro):
             assert found
 
 
+def test_rename_node_pipe(runner, invoke, test_avro, pipe):
+    with runner.isolated_filesystem():
+        result = invoke(
+            "rename",
+            "-o",
+            "output.avro",
+            "node",
+            "demographic",
+            "demo2",
+            input=pipe(test_avro),
+        )
+        assert result.exit_code == 0, result.output
+        with open("output.avro", "rb") as f:
+            names = [record["name"] for record in reader(f)]
+        assert "demo2" in names
+        assert "demographic" not in names
+
+
 def test_rename_enum(runner, invoke, test_avro):
     with runner.isolated_filesystem():
         result = invoke(
@@ -343,3 +641,102 @@ def test_rename_enum(runner, invoke, test_avro):
                     found = True
                     break
             assert found
+
+
+def test_show_stats(invoke, test_avro):
+    result = invoke("show", "stats", input=test_avro)
+    assert result.exit_code == 0, result.output
+    lines = result.output.splitlines()
+    assert lines[0] == "Total number of nodes: 36"
+    assert lines[1] == "Total number of edges: 32"
+    assert "sample: 1" in lines
+    assert "Codec: null" in lines
+
+    result = invoke("show", "stats", "sample", input=test_avro)
+    assert result.exit_code == 0, result.output
+    assert result.output.splitlines()[0] == "sample: 1"
+
+
+def test_merge(invoke, multi_block_pfb, tmp_path, pipe):
+    from copy import deepcopy
+
+    from pfb.reader import PFBReader
+    from pfb.writer import PFBWriter
+
+    with PFBReader(multi_block_pfb) as r:
+        all_records = list(r)
+        all_nodes = {node["name"] for node in r.schema}
+        blocks = [b.data for b in r.iter_raw_blocks()]
+    subset = str(tmp_path / "subset.avro")
+    with PFBReader(multi_block_pfb, nodes=["sample", "aliquot"]) as r:
+        records = list(r)
+        with PFBWriter(subset) as w:
+            w.copy_schema(r)
+            w.write(deepcopy(records))
+
+    merged = str(tmp_path / "merged.avro")
+    result = invoke("merge", "-o", merged, multi_block_pfb, multi_block_pfb)
+    assert result.exit_code == 0, result.output
+    with PFBReader(merged) as r:
+        assert list(r) == all_records * 2
+        merged_blocks = [b.data for b in r.iter_raw_blocks()]
+    # only the first block of the second file is encoded again
+    assert merged_blocks[: len(blocks)] == blocks
+    assert merged_blocks[len(blocks) + 1 :] == blocks[1:]
+
+    # different nodes are merged by decoding the records
+    result = invoke("merge", "-o", merged, subset, multi_block_pfb)
+    assert result.exit_code == 0, result.output
+    with PFBReader(merged) as r:
+        assert list(r) == records + all_records
+        assert {node["name"] for node in r.schema} == all_nodes
+
+    # a PFB read from a pipe is decoded too
+    with open(multi_block_pfb, "rb") as f:
+        piped = pipe(f.read())
+    result = invoke("merge", "-o", merged, "-", multi_block_pfb, input=piped)
+    assert result.exit_code == 0, result.output
+    with PFBReader(merged) as r:
+        assert list(r) == all_records * 2
+
+
+def test_split(runner, invoke, multi_block_pfb):
+    from pfb.reader import PFBReader
+
+    with PFBReader(multi_block_pfb) as r:
+        metadata = r.metadata
+        records = list(r)
+
+    def _read(path):
+        with PFBReader(path) as r:
+            assert r.metadata == metadata
+            return list(r)
+
+    with runner.isolated_filesystem():
+        result = invoke("split", "-i", multi_block_pfb, "--by-node", "nodes")
+        assert result.exit_code == 0, result.output
+        names = {r["name"] for r in records}
+        assert sorted(os.listdir("nodes")) == sorted(n + ".avro" for n in names)
+        for name in names:
+            assert _read(os.path.join("nodes", name + ".avro")) == [
+                r for r in records if r["name"] == name
+            ]
+
+        for option, value in [("--max-records", "70"), ("--max-bytes", "150000")]:
+            output = option.strip("-")
+            result = invoke("split", "-i", multi_block_pfb, option, value, output)
+            assert result.exit_code == 0, result.output
+            shards = sorted(os.listdir(output))
+            assert len(shards) > 1
+            split_records = []
+            for shard in shards:
+                shard_records = _read(os.path.join(output, shard))
+                if option == "--max-records":
+                    assert len(shard_records) <= 70
+                else:
+                    assert os.path.getsize(os.path.join(output, shard)) <= 150000
+                split_records.extend(shard_records)
+            assert split_records == records
+
+        result = invoke("split", "-i", multi_block_pfb, "nodes")
+        assert result.exit_code != 0
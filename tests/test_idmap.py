@@ -0,0 +1,17 @@
+import os
+
+from pfb.idmap import IdMap
+
+
+def test_spill():
+    with IdMap(memory_limit=2000) as ids:
+        for i in range(100):
+            ids["id_%d" % i] = "submitter_%d" % i
+        ids["id_0"] = "updated"
+        assert ids.spilled
+        path = ids._path
+        assert os.path.exists(path)
+        assert ids.get("id_0") == "updated"
+        assert all(ids.get("id_%d" % i) == "submitter_%d" % i for i in range(1, 100))
+        assert ids.get("unknown", "null") == "null"
+    assert not os.path.exists(path)
@@ -0,0 +1,93 @@
+import io
+import json
+import os
+import shutil
+
+import pytest
+from fastavro import reader
+
+from pfb.importers.files import iter_json, iter_records, order_files
+
+
+def test_iter_json():
+    records = [{"submitter_id": "a", "values": [1, -2.5e10, "]"]}, 123456789, None]
+    text = json.dumps(records, indent=1)
+    for chunk_size in (1, 2, 7, 1024):
+        assert list(iter_json(io.StringIO(text), chunk_size)) == records
+    assert list(iter_json(io.StringIO(json.dumps(records[0])), 2)) == records[:1]
+
+
+def test_order_files():
+    metadata = {
+        "nodes": [
+            {"name": "case", "links": [{"dst": "project"}]},
+            {"name": "project", "links": [{"dst": "program"}]},
+            {"name": "program", "links": []},
+            {"name": "sample", "links": [{"dst": "case"}, {"dst": "sample"}]},
+        ]
+    }
+    paths = ["d/sample.json", "d/case.json", "d/program.ndjson", "d/project.json"]
+    assert order_files(paths, metadata) == paths
+    assert order_files(paths, metadata, "topological") == [
+        "d/program.ndjson",
+        "d/project.json",
+        "d/case.json",
+        "d/sample.json",
+    ]
+
+
+def test_from_ndjson_parallel(runner, invoke, path_join):
+    def _records(path):
+        with open(path, "rb") as f:
+            return sorted((r["name"], r["id"]) for r in reader(f))
+
+    args = ["-s", path_join("schema", "kf.avro"), "--program", "DEV"]
+    args += ["--project", "test"]
+    with runner.isolated_filesystem():
+        shutil.copytree(path_join("data"), "data")
+        # one node as NDJSON
+        with open(os.path.join("data", "demographic.json")) as f:
+            demographics = json.load(f)
+        os.remove(os.path.join("data", "demographic.json"))
+        with open(os.path.join("data", "demographic.ndjson"), "w") as f:
+            for record in demographics:
+                f.write(json.dumps(record) + "\n")
+
+        result = invoke("from", "-o", "serial.avro", "json", path_join("data"), *args)
+        assert result.exit_code == 0, result.output
+        result = invoke(
+            "from",
+            "-o",
+            "parallel.avro",
+            "json",
+            "data",
+            "--order",
+            "topological",
+            "-p",
+            "3",
+            *args
+        )
+        assert result.exit_code == 0, result.output
+        assert _records("parallel.avro") == _records("serial.avro")
+
+
+def _exit(code):
+    yield {"id": "a"}
+    os._exit(code)
+
+
+def test_from_ndjson_parallel_errors(runner, invoke, path_join):
+    args = ["-s", path_join("schema", "kf.avro"), "--program", "DEV"]
+    args += ["--project", "test"]
+    with runner.isolated_filesystem():
+        shutil.copytree(path_join("data"), "data")
+        with open(os.path.join("data", "demographic.json"), "w") as f:
+            f.write('[{"submitter_id": "a"},')
+        result = invoke("from", "-o", "out.avro", "json", "data", "-p", "2", *args)
+        assert result.exit_code != 0
+        assert os.path.join("data", "demographic.json") in str(result.exception)
+
+    # a worker dying without sending all its records
+    tasks = [("a.json", _exit, (3,))]
+    with pytest.raises(RuntimeError, match="exited with code 3"):
+        list(iter_records(tasks, jobs=2))
@@ -0,0 +1,270 @@
+import csv
+import json
+import os
+
+import pytest
+
+import pfb.reader
+from pfb.reader import PFBReader
+from pfb.stats import collect_stats
+
+
+def test_index(invoke, multi_block_pfb):
+    result = invoke("index", multi_block_pfb)
+    assert result.exit_code == 0, result.output
+    assert os.path.exists(multi_block_pfb + ".pfbidx")
+
+    with PFBReader(multi_block_pfb) as reader:
+        index = reader.load_index()
+        assert index is not None
+        assert sum(count for _, _, count, _ in index["blocks"]) == 36 * 50 + 1
+        demographic_blocks = [b for b in index["blocks"] if "demographic" in b[3]]
+        assert len(demographic_blocks) < len(index["blocks"]) / 4
+
+        records = list(reader.iter_node("demographic"))
+        assert len(records) == 50
+        assert records == [r for r in reader if r["name"] == "demographic"]
+        assert records[0]["object"]["race"] == (
+            "Native Hawaiian or Other Pacific Islander"
+        )
+
+
+def test_stale_index(multi_block_pfb):
+    with PFBReader(multi_block_pfb) as reader:
+        reader.write_index()
+    with open(multi_block_pfb, "ab") as f:
+        f.write(b"\0")
+    with PFBReader(multi_block_pfb) as reader:
+        assert reader.load_index() is None
+
+
+def test_projection(path_join):
+    path = path_join("pfb-data", "test.avro")
+    with PFBReader(path) as reader:
+        expected = [r for r in reader if r["name"] in ("demographic", "sample")]
+
+    with PFBReader(
+        path,
+        nodes=["demographic"],
+        fields={"sample": ["submitter_id", "tissue_type"]},
+        relations=False,
+    ) as reader:
+        assert sorted(node["name"] for node in reader.schema) == [
+            "demographic",
+            "sample",
+        ]
+        records = list(reader)
+    assert [r["name"] for r in records] == [r["name"] for r in expected]
+    for record, full in zip(records, expected):
+        assert "relations" not in record
+        if record["name"] == "sample":
+            assert record["object"] == {
+                "submitter_id": full["object"]["submitter_id"],
+                "tissue_type": full["object"]["tissue_type"],
+            }
+        else:
+            assert record["object"] == full["object"]
+
+
+def test_projection_with_index(multi_block_pfb):
+    with PFBReader(multi_block_pfb) as reader:
+        reader.write_index()
+        expected = [r for r in reader if r["name"] == "diagnosis"]
+    with PFBReader(multi_block_pfb, nodes=["diagnosis"]) as reader:
+        assert list(reader) == expected
+
+
+def test_show_projection(invoke, test_avro):
+    result = invoke(
+        "show",
+        "--node",
+        "demographic",
+        "--field",
+        "sample.submitter_id",
+        input=test_avro,
+    )
+    assert result.exit_code == 0, result.output
+    records = [json.loads(line) for line in result.output.splitlines()]
+    assert sorted(r["name"] for r in records) == ["demographic", "sample"]
+    sample = [r for r in records if r["name"] == "sample"][0]
+    assert sample["object"] == {"submitter_id": "sample_Wagnerism_buccally"}
+
+    result = invoke("show", "--field", "sample", input=test_avro)
+    assert result.exit_code != 0
+
+
+def test_to_tsv_projection(runner, invoke, test_avro):
+    with runner.isolated_filesystem():
+        result = invoke(
+            "to",
+            "tsv",
+            "--field",
+            "demographic.submitter_id",
+            "./tsvs",
+            input=test_avro,
+        )
+        assert result.exit_code == 0, result.output
+        assert os.listdir("tsvs") == ["demographic.tsv"]
+        with open(os.path.join("tsvs", "demographic.tsv"), "rt") as f:
+            rows = list(csv.DictReader(f, delimiter="\t"))
+        assert rows == [
+            {
+                "type": "demographic",
+                "submitter_id": "demographic_duteousness_unassailing",
+                "participants.id": "participant_metalinguistics_monofilm",
+                "participants.submitter_id": "participant_metalinguistics_monofilm",
+                "id": "demographic_duteousness_unassailing",
+            }
+        ]
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_parallel(multi_block_pfb, monkeypatch, ordered):
+    monkeypatch.setattr(pfb.reader, "PARALLEL_TASK_SIZE", 64 * 1024)
+    with PFBReader(multi_block_pfb) as reader:
+        expected = list(reader)
+    with PFBReader(multi_block_pfb, parallel=3, ordered=ordered) as reader:
+        records = list(reader)
+    if ordered:
+        assert records == expected
+    else:
+        key = lambda r: (r["name"], json.dumps(r["object"], sort_keys=True))
+        assert sorted(records, key=key) == sorted(expected, key=key)
+
+    with PFBReader(multi_block_pfb, nodes=["sample"], parallel=2) as reader:
+        assert list(reader) == [r for r in expected if r["name"] == "sample"]
+
+
+def test_show_jobs(invoke, multi_block_pfb):
+    expected = invoke("show", "-i", multi_block_pfb)
+    result = invoke("show", "-i", multi_block_pfb, "--jobs", "2")
+    assert result.exit_code == 0, result.output
+    assert result.output == expected.output
+
+
+def test_memory_map(multi_block_pfb):
+    with PFBReader(multi_block_pfb) as reader:
+        assert reader._mmap is None
+        expected = list(reader)
+    with PFBReader(multi_block_pfb, memory_map=True) as reader:
+        assert reader._mmap is not None
+        assert list(reader) == expected
+        assert list(reader.iter_node("sample")) == [
+            r for r in expected if r["name"] == "sample"
+        ]
+    with PFBReader(
+        multi_block_pfb, fields={"sample": ["submitter_id"]}, memory_map=True
+    ) as reader:
+        assert reader._mmap is not None
+        assert len(list(reader)) == len(expected)
+    with PFBReader(multi_block_pfb, memory_map=True) as reader:
+        reader.write_index()
+    with PFBReader(multi_block_pfb, nodes=["sample"], memory_map=True) as reader:
+        assert reader._mmap is not None
+        assert list(reader) == [r for r in expected if r["name"] == "sample"]
+    with open(multi_block_pfb, "rb") as f:
+        with PFBReader(f, memory_map=True) as reader:
+            assert reader._mmap is not None
+            assert list(reader) == expected
+
+
+def test_stats(multi_block_pfb):
+    with open(multi_block_pfb, "rb") as f:
+        stats = collect_stats(f)
+    with PFBReader(multi_block_pfb) as reader:
+        records = list(reader)
+        header_size = reader._get_header().size
+    assert stats["records"] == len(records) == 36 * 50
+    assert stats["edges"] == sum(len(r["relations"]) for r in records)
+    assert stats["nodes"]["sample"]["records"] == 50
+    assert stats["compressed_bytes"] == os.path.getsize(multi_block_pfb) - header_size
+    # the share of the metadata record is not attributed to any node
+    assert (
+        0
+        < stats["compressed_bytes"]
+        - sum(n["compressed_bytes"] for n in stats["nodes"].values())
+        < stats["compressed_bytes"] / stats["blocks"]
+    )
+
+
+def test_manifest(path_join, multi_block_pfb, tmp_path):
+    from copy import deepcopy
+
+    from pfb.manifest import load_manifest
+    from pfb.writer import PFBWriter
+
+    path = str(tmp_path / "manifest.avro")
+    with PFBReader(multi_block_pfb) as reader:
+        records = list(reader)
+        with PFBWriter(path, manifest=True) as writer:
+            writer.copy_schema(reader)
+            writer.write(deepcopy(r) for r in records)
+
+    with open(multi_block_pfb, "rb") as f:
+        scanned = collect_stats(f)
+    with PFBReader(path) as reader:
+        assert list(reader) == records
+        manifest = load_manifest(reader._get_header(), os.path.getsize(path))
+        index = reader.make_index()
+    assert manifest["blocks"] == [b[:3] for b in index["blocks"]]
+
+    with open(path, "rb") as f:
+        stats = collect_stats(f)
+    assert stats == manifest["stats"]
+    assert stats["blocks"] == scanned["blocks"]
+    assert stats["uncompressed_bytes"] == scanned["uncompressed_bytes"]
+    for name, counts in scanned["nodes"].items():
+        assert stats["nodes"][name]["records"] == counts["records"]
+        assert stats["nodes"][name]["edges"] == counts["edges"]
+
+    # a stale manifest is ignored
+    with PFBReader(path) as reader:
+        with open(path, "a+b") as f:
+            with PFBWriter(f) as writer:
+                writer.copy_schema(reader)
+                writer.write([deepcopy(records[-1])], metadata=False)
+    with open(path, "rb") as f:
+        stats = collect_stats(f)
+    assert stats["records"] == manifest["stats"]["records"] + 1
+
+
+def test_schema_cache(path_join):
+    from pfb.cache import clear_cache
+
+    clear_cache()
+    path = path_join("pfb-data", "test.avro")
+    with PFBReader(path) as r1, PFBReader(path) as r2:
+        assert r1.schema is r2.schema
+        assert r1._decode_plan is r2._decode_plan
+    with PFBReader(path, nodes=["sample"]) as r3:
+        assert r3.schema is not r1.schema
+        assert [node["name"] for node in r3.schema] == ["sample"]
+
+
+def test_iter_batches(multi_block_pfb):
+    with PFBReader(multi_block_pfb) as reader:
+        records = [r for r in reader if r["name"] == "sample"]
+    with PFBReader(multi_block_pfb) as reader:
+        batches = list(reader.iter_batches(batch_size=20, node="sample"))
+    assert [len(b.columns["id"]) for b in batches] == [20, 20, 10]
+    assert {b.name for b in batches} == {"sample"}
+
+    for i, record in enumerate(records):
+        batch = batches[i // 20]
+        j = i % 20
+        assert batch.columns["id"][j] == record["id"]
+        assert batch.columns["relations"][j] == record["relations"]
+        for field, value in record["object"].items():
+            column = batch.columns[field]
+            if field in batch.symbols:
+                assert batch.symbols[field][column[j]] == value
+            else:
+                assert column[j] == value
+    assert str(batches[0].columns["age_at_event_days"].dtype) == "int64"
+
+    with PFBReader(multi_block_pfb) as reader:
+        batches = list(reader.iter_batches(batch_size=1000))
+    assert sum(len(b.columns["id"]) for b in batches) == 36 * 50
+    with PFBReader(multi_block_pfb, parallel=2) as reader:
+        parallel = list(reader.iter_batches(batch_size=1000))
+    assert [b.columns["id"] for b in parallel] == [b.columns["id"] for b in batches]
@@ -0,0 +1,156 @@
+from copy import deepcopy
+
+import pytest
+
+from pfb.reader import PFBReader
+from pfb.stats import collect_stats
+from pfb.writer import CODEC_ALIASES, PFBWriter
+
+
+def _rewrite(src, dst, *renames):
+    with PFBReader(src) as reader:
+        with PFBWriter(dst) as writer:
+            writer.copy_schema(reader)
+            for method, args in renames:
+                getattr(writer, method)(*args)
+            writer.write(reader)
+    with PFBReader(dst) as reader:
+        return list(reader)
+
+
+def test_write_round_trip(path_join, tmp_path):
+    src = path_join("pfb-data", "test.avro")
+    with PFBReader(src) as reader:
+        records = list(reader)
+    assert _rewrite(src, str(tmp_path / "copy.avro")) == records
+
+
+def test_chained_renames(path_join, tmp_path):
+    src = path_join("pfb-data", "test.avro")
+    records = _rewrite(
+        src,
+        str(tmp_path / "renamed.avro"),
+        ("rename_node", ("outcome", "outcome2")),
+        ("rename_node", ("outcome2", "outcome3")),
+        ("rename_enum", ("state", "validated", "validated 2")),
+        ("rename_enum", ("state", "validated 2", "validated-3")),
+    )
+    names = {r["name"] for r in records}
+    assert "outcome3" in names
+    assert not names & {"outcome", "outcome2"}
+    states = {r["object"].get("state") for r in records}
+    assert "validated-3" in states
+    assert not states & {"validated", "validated 2"}
+
+
+@pytest.mark.parametrize("codec", ["deflate", "bz2", "xz"])
+def test_codec(path_join, tmp_path, codec):
+    src = path_join("pfb-data", "test.avro")
+    dst = str(tmp_path / "compressed.avro")
+    with PFBReader(src) as reader:
+        records = list(reader)
+        with PFBWriter(
+            dst, codec=codec, codec_compression_level=9, sync_interval=1024
+        ) as writer:
+            writer.copy_schema(reader)
+            writer.write(deepcopy(r) for r in records)
+    with PFBReader(dst) as reader:
+        assert list(reader) == records
+    with open(dst, "rb") as f:
+        stats = collect_stats(f)
+    assert stats["codec"] == CODEC_ALIASES.get(codec, codec)
+    assert stats["blocks"] > 1
+
+
+def test_unknown_codec(tmp_path):
+    with pytest.raises(ValueError):
+        PFBWriter(str(tmp_path / "out.avro"), codec="gzip")
+
+
+@pytest.mark.parametrize("manifest", [False, True])
+def test_parallel(multi_block_pfb, tmp_path, monkeypatch, manifest):
+    import pfb.writer
+
+    monkeypatch.setattr(pfb.writer, "PARALLEL_TASK_RECORDS", 100)
+    with PFBReader(multi_block_pfb) as reader:
+        records = list(reader)
+        paths = []
+        for parallel in (None, 1, 3):
+            paths.append(str(tmp_path / "{}.avro".format(parallel)))
+            with PFBWriter(
+                paths[-1], codec="deflate", parallel=parallel, manifest=manifest
+            ) as writer:
+                writer.copy_schema(reader)
+                writer.write(deepcopy(r) for r in records)
+
+    stats = []
+    for path in paths:
+        with PFBReader(path) as reader:
+            assert list(reader) == records
+        with open(path, "rb") as f:
+            stats.append(collect_stats(f))
+    # the blocks end at the same records whatever the number of processes
+    assert stats[0] == stats[1] == stats[2]
+
+
+def _copy(src, dst, renames, **kwargs):
+    with PFBReader(src) as reader:
+        with PFBWriter(dst, **kwargs) as writer:
+            writer.copy_schema(reader)
+            for method, args in renames:
+                getattr(writer, method)(*args)
+            writer.copy_records(reader)
+    with PFBReader(dst) as reader:
+        return list(reader), [b.data for b in reader.iter_raw_blocks()]
+
+
+def test_copy_records_other_envelope(multi_block_pfb, tmp_path):
+    from fastavro import reader, writer
+
+    from pfb.writer import make_avro_schema
+
+    # a PFB file whose records have their id union in the other order
+    path = str(tmp_path / "envelope.avro")
+    with PFBReader(multi_block_pfb) as pfb:
+        schema = make_avro_schema(pfb.schema)
+    schema["fields"][0]["type"] = ["string", "null"]
+    with open(multi_block_pfb, "rb") as f:
+        records = list(reader(f, return_record_name=True))
+    with open(path, "wb") as f:
+        writer(f, schema, records)
+
+    with PFBReader(path) as pfb:
+        expected = list(pfb)
+    copied, _ = _copy(path, str(tmp_path / "copy.avro"), [])
+    assert copied == expected
+
+
+@pytest.mark.parametrize(
+    "renames",
+    [
+        [("rename_enum", ("state", "validated", "validated 2"))],
+        [("rename_node", ("outcome", "outcome2"))],
+        [
+            ("rename_node", ("outcome", "outcome2")),
+            ("rename_enum", ("state", "validated", "validated 2")),
+        ],
+    ],
+)
+def test_copy_records(multi_block_pfb, tmp_path, renames):
+    with PFBReader(multi_block_pfb) as reader:
+        blocks = [b.data for b in reader.iter_raw_blocks()]
+    expected = _rewrite(multi_block_pfb, str(tmp_path / "expected.avro"), *renames)
+    records, copied = _copy(multi_block_pfb, str(tmp_path / "copy.avro"), renames)
+    assert records == expected
+    if renames[0][0] == "rename_enum":
+        assert copied == blocks
+    else:
+        # only the blocks of the renamed node are encoded again
+        assert 0 < len(set(blocks) - set(copied)) < len(blocks) / 10
+
+    # recompressing needs to decode the records
+    records, copied = _copy(
+        multi_block_pfb, str(tmp_path / "deflate.avro"), renames, codec="deflate"
+    )
+    assert records == expected
+    assert not set(copied) & set(blocks)